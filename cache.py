@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+CACHE_DIR = os.environ.get("NOTE_TAKER_CACHE_DIR", os.path.abspath("cache"))
+
+
+def hash_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """Small SQLite key-value store with TTL and size-bounded LRU eviction."""
+
+    def __init__(self, name, max_bytes=256 * 1024**2, ttl=None, cache_dir=None):
+        self.path = os.path.join(cache_dir or CACHE_DIR, f"{name}.sqlite3")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT, size INTEGER, "
+                "created REAL, accessed REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+            )
+            self._initialized = True
+        return connection
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            if not os.path.exists(self.path):
+                return default
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    "SELECT value, created FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return default
+                if self.ttl is not None and now - row[1] > self.ttl:
+                    connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    connection.commit()
+                    return default
+                connection.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+                )
+                connection.commit()
+            finally:
+                connection.close()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = self._connect()
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                    (key, data, size, now, now),
+                )
+                self._evict(connection, now)
+                connection.commit()
+            finally:
+                connection.close()
+
+    def delete(self, key):
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            connection = self._connect()
+            try:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                connection.commit()
+            finally:
+                connection.close()
+
+    def _evict(self, connection, now):
+        if self.ttl is not None:
+            connection.execute(
+                "DELETE FROM entries WHERE created < ?", (now - self.ttl,)
+            )
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = connection.execute(
+            "SELECT key, size FROM entries ORDER BY accessed ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            logging.getLogger(__name__).debug(f"Evicted cache entry {key}")
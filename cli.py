@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from core_func import run_job
+from scheduler import StageScheduler, default_stage_workers
+from server import serve
+from client import JobClient, server_can_read
+from utils import whisper_profiles, get_tuned_compute_type
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
+
+logger = logging.getLogger("note-taker")
+
+
+def load_setting(setting_file):
+    try:
+        with open(setting_file, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        logger.warning("Settings file not found.")
+        return {}
+
+
+def load_manifest(manifest_file):
+    # A JSON list of inputs or job objects, or one URL/file path per line.
+    # Returns the jobs and the failed results of the entries that are no job.
+    with open(manifest_file, "r", encoding="utf-8") as file:
+        if manifest_file.endswith(".json"):
+            entries = json.load(file)
+        else:
+            entries = [
+                line.strip()
+                for line in file
+                if line.strip() and not line.strip().startswith("#")
+            ]
+    if not isinstance(entries, list):
+        raise ValueError(f"{manifest_file} is not a JSON list.")
+
+    jobs, invalid = [], []
+    for index, entry in enumerate(entries, start=1):
+        job = {"input": entry} if isinstance(entry, str) else entry
+        if isinstance(job, dict) and isinstance(job.get("input"), str) and job["input"]:
+            jobs.append(job)
+            continue
+        logger.error(f"Manifest entry {index} has no 'input': {entry!r}")
+        invalid.append(
+            {
+                "input": job.get("input") if isinstance(job, dict) else entry,
+                "status": "failed",
+                "error": f"Manifest entry {index} has no 'input' URL or file path.",
+                "timings": {},
+            }
+        )
+    return jobs, invalid
+
+
+def build_setting(args):
+    setting = load_setting(args.setting)
+    overrides = {
+        "chatgpt_api": args.openai_key or os.environ.get("OPENAI_API_KEY"),
+        "notion_api": args.notion_key or os.environ.get("NOTION_API_KEY"),
+        "database_id": args.database_id or os.environ.get("NOTION_DATABASE_ID"),
+        "language": args.language,
+        "whisper_model": args.whisper_model,
+        "whisper_profile": args.whisper_profile,
+        "gpt_model": args.gpt_model,
+        "gpt_workers": args.gpt_workers,
+        "stream_notes": args.stream,
+    }
+    setting.update({key: value for key, value in overrides.items() if value})
+    if args.no_compress:
+        setting["compress_transcript"] = False
+    return setting
+
+
+def parse_stage_workers(stage_workers):
+    # "download=2,transcribe=1,notes=4,upload=1"
+    if not stage_workers:
+        return None
+    workers = {}
+    for item in stage_workers.split(","):
+        name, _, count = item.partition("=")
+        name = name.strip()
+        if name not in default_stage_workers:
+            stages = ", ".join(default_stage_workers)
+            raise ValueError(f"Unknown stage '{name}', the stages are {stages}.")
+        if not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(f"Stage '{name}' needs at least 1 worker.")
+        workers[name] = int(count)
+    return workers
+
+
+def positive_int(value):
+    # argparse type of the worker counts, a stage without workers never ends
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a whole number.")
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"{count} is less than 1.")
+    return count
+
+
+def stage_workers_type(value):
+    try:
+        return parse_stage_workers(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def run_remote_jobs(jobs, args):
+    # The daemon uses its own keys and settings, only the job options are sent
+    options = {
+        "language": args.language,
+        "whisper_model": args.whisper_model,
+        "whisper_profile": args.whisper_profile,
+        "gpt_model": args.gpt_model,
+        "stream_notes": args.stream,
+    }
+    client = JobClient(args.server, token=args.token)
+    results = []
+    submitted = []
+    for job in jobs:
+        if not server_can_read(args.server, job["input"]):
+            logger.error(f"Only URLs can be sent to a server: {job['input']}")
+            results.append(
+                {
+                    "input": job["input"],
+                    "status": "failed",
+                    "error": "Only URLs can be sent to another host.",
+                }
+            )
+            continue
+        job = dict({key: value for key, value in options.items() if value}, **job)
+        if args.no_compress:
+            job.setdefault("compress_transcript", False)
+        try:
+            submitted.append((job, client.submit(job)))
+        except requests.RequestException as e:
+            logger.error(f"Failed to submit {job['input']}: {e}")
+            results.append({"input": job["input"], "status": "failed", "error": str(e)})
+    logger.info(f"Submitted {len(submitted)} jobs to {args.server}")
+
+    for job, job_id in submitted:
+        try:
+            results.append(client.wait(job_id))
+        except requests.RequestException as e:
+            logger.error(f"Lost job {job_id}: {e}")
+            results.append({"input": job["input"], "status": "failed", "error": str(e)})
+    return results
+
+
+def run(args):
+    jobs = [{"input": user_input} for user_input in args.inputs]
+    invalid = []
+    if args.manifest:
+        manifest_jobs, invalid = load_manifest(args.manifest)
+        jobs += manifest_jobs
+    if not jobs and not invalid:
+        logger.error("Nothing to do, give inputs or a manifest.")
+        return 1
+    setting = build_setting(args)
+
+    start = time.perf_counter()
+    stages = None
+    if args.server:
+        results = run_remote_jobs(jobs, args)
+    elif args.pipeline:
+        logger.info(f"Running {len(jobs)} jobs through the stage scheduler")
+        scheduler = StageScheduler(
+            setting, stage_workers=args.stage_workers, logger=logger
+        )
+        results = scheduler.run(jobs)
+        stages = scheduler.utilization()
+    else:
+        logger.info(f"Running {len(jobs)} jobs with concurrency {args.concurrency}")
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(
+                executor.map(lambda job: run_job(job, setting, logger=logger), jobs)
+            )
+
+    results += invalid
+    report = {
+        "total": len(results),
+        "completed": sum(result["status"] == "completed" for result in results),
+        "failed": sum(result["status"] != "completed" for result in results),
+        "elapsed": round(time.perf_counter() - start, 2),
+        "jobs": results,
+    }
+    if stages is not None:
+        report["stages"] = stages
+        for name, stage in stages.items():
+            logger.info(
+                f"Stage {name}: {stage['jobs']} jobs, {stage['workers']} workers, "
+                f"utilization {stage['utilization']:.0%}"
+            )
+    if args.report == "-":
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    else:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        logger.info(f"Report saved as '{args.report}'")
+    logger.info(
+        f"{report['completed']} of {report['total']} jobs completed "
+        f"in {report['elapsed']}s"
+    )
+    return 0 if report["failed"] == 0 else 1
+
+
+def run_server(args):
+    try:
+        serve(
+            build_setting(args),
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            token=args.token,
+            logger=logger,
+        )
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    return 0
+
+
+def run_tune(args):
+    setting = build_setting(args)
+    model_size = setting.get("whisper_model", "medium")
+    for profile in args.profiles or list(whisper_profiles):
+        device, compute_type = get_tuned_compute_type(
+            model_size,
+            profile,
+            file_path=args.audio,
+            logger=logger,
+            refresh=True,
+        )
+        logger.info(f"{model_size} {profile}: {compute_type} on {device}")
+    return 0
+
+
+def add_setting_arguments(parser):
+    parser.add_argument("--setting", default="setting.json")
+    parser.add_argument("--language")
+    parser.add_argument("--whisper-model")
+    parser.add_argument("--whisper-profile", choices=list(whisper_profiles))
+    parser.add_argument("--gpt-model")
+    parser.add_argument("--gpt-workers", type=positive_int)
+    parser.add_argument(
+        "--no-compress",
+        action="store_true",
+        help="Send the transcription to GPT without removing fillers and loops",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Fill the Notion page part by part while the notes are being written",
+    )
+    parser.add_argument("--openai-key")
+    parser.add_argument("--notion-key")
+    parser.add_argument("--database-id")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="note-taker", description="Take notes for online videos into Notion."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run note-taking jobs headlessly.")
+    run_parser.add_argument("inputs", nargs="*", help="URLs or file paths")
+    run_parser.add_argument(
+        "-m", "--manifest", help="JSON list or text file with one input per line"
+    )
+    run_parser.add_argument("-c", "--concurrency", type=positive_int, default=1)
+    run_parser.add_argument(
+        "-r", "--report", default="report.json", help="Result report, '-' for stdout"
+    )
+    run_parser.add_argument(
+        "-p",
+        "--pipeline",
+        action="store_true",
+        help="Overlap download, transcription, notes and upload across jobs",
+    )
+    run_parser.add_argument(
+        "--stage-workers",
+        type=stage_workers_type,
+        help="e.g. download=2,transcribe=1,notes=4,upload=1",
+    )
+    run_parser.add_argument(
+        "-s", "--server", help="Send the jobs to a daemon, e.g. http://host:8765"
+    )
+    run_parser.add_argument("--token", default=os.environ.get("NOTE_TAKER_TOKEN"))
+    add_setting_arguments(run_parser)
+    run_parser.set_defaults(func=run)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run the job daemon with an HTTP API."
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument(
+        "-w",
+        "--workers",
+        type=positive_int,
+        default=1,
+        help="Jobs run at the same time",
+    )
+    serve_parser.add_argument(
+        "--token",
+        default=os.environ.get("NOTE_TAKER_TOKEN"),
+        help="Require 'Authorization: Bearer <token>' from clients",
+    )
+    add_setting_arguments(serve_parser)
+    serve_parser.set_defaults(func=run_server)
+
+    tune_parser = subparsers.add_parser(
+        "tune", help="Benchmark the compute types of a Whisper model on this machine."
+    )
+    tune_parser.add_argument("audio", help="Audio file to benchmark on (first 30 s)")
+    tune_parser.add_argument(
+        "--profiles", nargs="*", choices=list(whisper_profiles), help="Default: all"
+    )
+    add_setting_arguments(tune_parser)
+    tune_parser.set_defaults(func=run_tune)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        stream=sys.stderr,
+    )
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import time
+import ipaddress
+import requests
+from urllib.parse import urlparse
+
+
+finished_statuses = ("completed", "failed", "cancelled")
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def server_can_read(server_url, user_input):
+    # A daemon on another host cannot read the files of this one
+    return user_input.startswith("https") or is_loopback(urlparse(server_url).hostname)
+
+
+class JobClient:
+    """Client of the job API served by `python cli.py serve`."""
+
+    def __init__(self, url, token=None, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def _request(self, method, path, payload=None):
+        response = self.session.request(
+            method, f"{self.url}/{path}", json=payload, timeout=self.timeout
+        )
+        if response.status_code >= 400:
+            try:
+                error = response.json().get("error")
+            except ValueError:
+                error = response.text
+            raise requests.HTTPError(
+                f"{response.status_code}: {error}", response=response
+            )
+        return response.json()
+
+    def submit(self, job):
+        return self._request("POST", "jobs", job)["id"]
+
+    def status(self, job_id):
+        return self._request("GET", f"jobs/{job_id}")
+
+    def list(self):
+        return self._request("GET", "jobs")
+
+    def cancel(self, job_id):
+        return self._request("POST", f"jobs/{job_id}/cancel")
+
+    def result(self, job_id):
+        return self._request("GET", f"jobs/{job_id}/result")
+
+    def wait(self, job_id, on_status=None, poll_interval=1.0):
+        # Polls until the job is finished and returns its result
+        while True:
+            status = self.status(job_id)
+            if on_status is not None:
+                on_status(status)
+            if status["status"] in finished_statuses:
+                return self.result(job_id)
+            time.sleep(poll_interval)
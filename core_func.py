@@ -1,23 +1,73 @@
 import os
-from openai import OpenAI
-import requests
 import json
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from utils import (
+    extract_video_info,
     get_video_info,
     download_subtitle,
-    find_matching_item,
+    find_caption_track,
     convert_ass_to_text,
     convert_srt_vtt_to_text,
     download_audio,
+    fasterWhisperSegments,
     fasterWhisperTranscribe,
     whisperAPITranscribe,
     parse_input,
+    NotesParser,
     split_text_by_token_limit_tiktoken,
-    check_property_exists,
-    add_property_to_database,
+    get_tail_by_token_limit,
+    group_texts_by_token_limit,
+    count_tokens,
+    is_in_language,
+    stream_text_by_token_limit_tiktoken,
     language_dict,
+    file_digest,
+    get_openai_client,
+    compress_transcript,
+    compress_text_stream,
+    log_compression,
 )
+from notion import get_notion_client
+from cache import DiskCache, hash_key
+from jobs import JobJournal, JobCancelled
+
+
+# Transcriptions keyed by audio hash or video id, Whisper model, speed profile
+# and language
+transcript_cache = DiskCache("transcripts", max_bytes=512 * 1024**2)
+
+
+def get_audio_transcript_key(audio_file, language, model_size, profile="balanced"):
+    return hash_key("audio", file_digest(audio_file), model_size, profile, language)
+
+
+def get_video_transcript_key(info, language, model_size, profile="balanced"):
+    return hash_key(
+        "video",
+        info.get("extractor_key"),
+        info.get("id"),
+        model_size,
+        profile,
+        language,
+    )
+
+
+def get_caption_transcript_key(info, source, sub_language):
+    return hash_key(
+        "caption", info.get("extractor_key"), info.get("id"), source, sub_language
+    )
+
+
+def get_cached_transcription(cache_key, logger=None):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    transcription = transcript_cache.get(cache_key)
+    if transcription is not None:
+        logger.info("Using cached transcription.")
+    return transcription
 
 
 def get_transcription_from_audio(
@@ -28,9 +78,22 @@ def get_transcription_from_audio(
     update_progress_bar=None,
     logger=None,
     file_remove=True,
+    whisper_profile="balanced",
+    batched=None,
 ):
+    # batched=True decodes many 30 s windows per forward pass, False keeps the
+    # sequential decoder and None leaves it to the speed profile
     if logger is None:
         logger = logging.getLogger(__name__)
+    cache_key = get_audio_transcript_key(
+        audio_file, language, model_size, whisper_profile
+    )
+    transcription = get_cached_transcription(cache_key, logger=logger)
+    if transcription is not None:
+        if file_remove:
+            os.remove(audio_file)
+        return transcription
+
     if model_size == "Whisper API":
         transcription = whisperAPITranscribe(
             audio_file, language_dict[language][0], api_token, logger=logger
@@ -45,8 +108,44 @@ def get_transcription_from_audio(
             update_progress_bar=update_progress_bar,
             logger=logger,
             file_remove=file_remove,
+            profile=whisper_profile,
+            batched=batched,
         )
         os.remove(audio_file + ".txt")
+    transcript_cache.set(cache_key, transcription)
+    return transcription
+
+
+def get_transcription_from_captions(youtube_url, language, info, logger=None):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    sub_source, sub_language = find_caption_track(info, language)
+    if sub_language is None:
+        return None
+    logger.info(f"Using {sub_source} captions: {sub_language}")
+    cache_key = get_caption_transcript_key(info, sub_source, sub_language)
+    transcription = get_cached_transcription(cache_key, logger=logger)
+    if transcription is not None:
+        return transcription
+
+    subtitle_file, sub_format = download_subtitle(
+        youtube_url, lang=sub_language, logger=logger, info=info, source=sub_source
+    )
+
+    if not subtitle_file or not os.path.exists(subtitle_file):
+        return None
+
+    if sub_format in ["srt", "vtt"]:
+        transcription = convert_srt_vtt_to_text(subtitle_file)
+    elif sub_format == "ass":
+        transcription = convert_ass_to_text(subtitle_file)
+    else:
+        transcription = None
+        logger.error("Unsupported subtitle format")
+    os.remove(subtitle_file)
+    if transcription is not None:
+        transcript_cache.set(cache_key, transcription)
     return transcription
 
 
@@ -57,171 +156,1087 @@ def get_transcription_from_url(
     api_token="",
     update_progress_bar=None,
     logger=None,
+    whisper_profile="balanced",
 ):
     if logger is None:
         logger = logging.getLogger(__name__)
 
-    title, subtitles = get_video_info(youtube_url)
-    sub_language = find_matching_item(language_dict[language], subtitles)
-    subtitle_file, sub_format = download_subtitle(
-        youtube_url, lang=sub_language, logger=logger
+    info = extract_video_info(youtube_url, logger=logger)
+    title, _ = get_video_info(youtube_url, info=info)
+    transcription = get_transcription_from_captions(
+        youtube_url, language, info, logger=logger
     )
 
-    if subtitle_file and os.path.exists(subtitle_file):
-        if sub_format in ["srt", "vtt"]:
-            transcription = convert_srt_vtt_to_text(subtitle_file)
-        elif sub_format == "ass":
-            transcription = convert_ass_to_text(subtitle_file)
-        else:
-            transcription = None
-            logger.error("Unsupported subtitle format")
-        os.remove(subtitle_file)
+    if transcription is None:
+        cache_key = get_video_transcript_key(
+            info, language, model_size, whisper_profile
+        )
+        transcription = get_cached_transcription(cache_key, logger=logger)
 
-    else:
+    if transcription is None:
         logger.warning("Subtitle file not found. Downloading the audio....")
-        audio_file = download_audio(youtube_url, logger=logger)
+        audio_file = download_audio(youtube_url, logger=logger, info=info)
         logger.info("Transcribing the audio....")
         transcription = get_transcription_from_audio(
-            audio_file, language, model_size, api_token, update_progress_bar, logger
+            audio_file,
+            language,
+            model_size,
+            api_token,
+            update_progress_bar,
+            logger,
+            whisper_profile=whisper_profile,
         )
+        transcript_cache.set(cache_key, transcription)
 
     logger.info("Transcription process completed.")
     return transcription, title
 
 
-def take_notes_chatgpt(
-    transcription,
+def chunk_segments(segments, language, compress=True, logger=None):
+    # Chunks of Whisper segments for the notes, the same on a resumed job
+    if compress:
+        segments = compress_text_stream(
+            segments, language_dict[language][0], logger=logger
+        )
+    return stream_text_by_token_limit_tiktoken(segments, token_limit=1000)
+
+
+def take_notes_from_audio(
+    audio_file,
     language,
     api_token,
+    model_size="medium",
     model_name="GPT-4o-mini",
-    save_reply=False,
+    update_progress_bar=None,
     logger=None,
+    file_remove=True,
+    max_workers=1,
+    journal=None,
+    whisper_profile="balanced",
+    compress=True,
+    on_notes=None,
 ):
+    # Pipelined version of get_transcription_from_audio + take_notes_chatgpt:
+    # each chunk goes to GPT as soon as Whisper has produced it
     if logger is None:
         logger = logging.getLogger(__name__)
-    if save_reply:
-        with open("conversation.txt", "w", encoding="utf-8") as file:
-            pass
+    if journal is None:
+        journal = JobJournal()
+    transcription = journal.get("transcription")
+    if transcription is None:
+        cache_key = get_audio_transcript_key(
+            audio_file, language, model_size, whisper_profile
+        )
+        transcription = get_cached_transcription(cache_key, logger=logger)
+    if transcription is not None:
+        if file_remove and os.path.exists(audio_file):
+            os.remove(audio_file)
+    elif model_size == "Whisper API":
+        transcription = get_transcription_from_audio(
+            audio_file,
+            language,
+            model_size,
+            api_token,
+            logger=logger,
+            file_remove=file_remove,
+        )
+    if transcription is not None:
+        journal.set("transcription", transcription)
+        notes = take_notes_chatgpt(
+            transcription,
+            language,
+            api_token,
+            model_name=model_name,
+            logger=logger,
+            max_workers=max_workers,
+            journal=journal,
+            compress=compress,
+            on_notes=on_notes,
+        )
+        return transcription, notes
+
+    chunk_queue = queue.Queue()
+    aborted = object()
+
+    def queued_chunks():
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None:
+                return
+            if chunk is aborted:
+                # Notes of part of the transcription must not pass as the notes
+                raise RuntimeError("The transcription stopped before its end.")
+            yield chunk
+
+    segments = []
+
+    def transcribed_segments():
+        # Keep the side file current so a crash still leaves the transcription
+        with open(audio_file + ".txt", "w", encoding="utf-8") as file:
+            for text in fasterWhisperSegments(
+                audio_file,
+                language_dict[language][0],
+                model_size=model_size,
+                update_progress_bar=update_progress_bar,
+                logger=logger,
+                profile=whisper_profile,
+            ):
+                journal.check_cancelled()
+                file.write(text)
+                file.flush()
+                segments.append(text)
+                yield text
+
+    # Whisper runs in this thread so progress callbacks stay on the caller's
+    # thread, while the note-taking stage consumes chunks in the background
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        notes_future = executor.submit(
+            take_notes_from_chunks,
+            queued_chunks(),
+            language,
+            api_token,
+            model_name=model_name,
+            logger=logger,
+            max_workers=max_workers,
+            journal=journal,
+            on_notes=on_notes,
+        )
+        chunks = chunk_segments(
+            transcribed_segments(), language, compress, logger=logger
+        )
+        try:
+            for chunk in chunks:
+                if notes_future.done() and notes_future.exception() is not None:
+                    # The notes failed, stop Whisper and raise their error
+                    break
+                chunk_queue.put(chunk)
+            else:
+                # Whisper has finished, keep its work even if the notes fail
+                transcription = "".join(segments)
+                transcript_cache.set(cache_key, transcription)
+                journal.set("segments", segments)
+                journal.set("transcription", transcription)
+        except BaseException:
+            chunk_queue.put(aborted)
+            raise
+        chunk_queue.put(None)
+        notes = notes_future.result()
+
+    os.remove(audio_file + ".txt")
+    if file_remove:
+        os.remove(audio_file)
+    logger.info("Transcription process completed.")
+    return transcription, notes
+
 
-    client = OpenAI(
-        api_key=api_token,
+def take_notes_from_url(
+    youtube_url,
+    language,
+    api_token,
+    model_size="medium",
+    model_name="GPT-4o-mini",
+    update_progress_bar=None,
+    logger=None,
+    max_workers=1,
+    journal=None,
+    whisper_profile="balanced",
+    compress=True,
+    on_notes=None,
+):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if journal is None:
+        journal = JobJournal()
+    if journal.get("notes") is not None:
+        logger.info("Notes already taken, skipping to the Notion page.")
+        return journal.get("transcription"), journal.get("notes"), journal.get("title")
+
+    info = extract_video_info(youtube_url, logger=logger)
+    title, _ = get_video_info(youtube_url, info=info)
+    journal.set("title", title)
+    cache_key = get_video_transcript_key(info, language, model_size, whisper_profile)
+    transcription = journal.get("transcription")
+    if transcription is None:
+        transcription = get_transcription_from_captions(
+            youtube_url, language, info, logger=logger
+        )
+    if transcription is None:
+        transcription = get_cached_transcription(cache_key, logger=logger)
+
+    if transcription is not None:
+        journal.set("transcription", transcription)
+        notes = take_notes_chatgpt(
+            transcription,
+            language,
+            api_token,
+            model_name=model_name,
+            logger=logger,
+            max_workers=max_workers,
+            journal=journal,
+            compress=compress,
+            on_notes=on_notes,
+        )
+        return transcription, notes, title
+
+    audio_file = journal.get("audio_file")
+    if audio_file is None or not os.path.exists(audio_file):
+        logger.warning("Subtitle file not found. Downloading the audio....")
+        audio_file = download_audio(
+            youtube_url,
+            logger=logger,
+            info=info,
+            progress_hook=lambda status: journal.check_cancelled(),
+        )
+        journal.set("audio_file", audio_file)
+    logger.info("Transcribing the audio and taking the notes....")
+    transcription, notes = take_notes_from_audio(
+        audio_file,
+        language,
+        api_token,
+        model_size=model_size,
+        model_name=model_name,
+        update_progress_bar=update_progress_bar,
+        logger=logger,
+        max_workers=max_workers,
+        journal=journal,
+        whisper_profile=whisper_profile,
+        compress=compress,
+        on_notes=on_notes,
     )
-    logging.getLogger("openai").setLevel(logging.ERROR)
-    if model_name == "GPT-3.5-turbo":
-        model = "gpt-3.5-turbo-0125"
-    elif model_name == "GPT-4o-mini":
-        model = "gpt-4o-mini"
-    elif model_name == "GPT-4o":
-        model = "gpt-4o"
+    transcript_cache.set(cache_key, transcription)
+    return transcription, notes, title
+
+
+def take_notes_from_input(
+    user_input,
+    language,
+    api_token,
+    model_size="medium",
+    model_name="GPT-4o-mini",
+    update_progress_bar=None,
+    logger=None,
+    max_workers=1,
+    journal=None,
+    whisper_profile="balanced",
+    compress=True,
+    on_notes=None,
+):
+    # Takes notes of a URL or a video/audio/subtitle/text file path.
+    # Returns (transcription, notes, title).
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if user_input.startswith("https"):
+        return take_notes_from_url(
+            user_input,
+            language,
+            api_token,
+            model_size=model_size,
+            model_name=model_name,
+            update_progress_bar=update_progress_bar,
+            logger=logger,
+            max_workers=max_workers,
+            journal=journal,
+            whisper_profile=whisper_profile,
+            compress=compress,
+            on_notes=on_notes,
+        )
+
+    title = os.path.splitext(os.path.basename(user_input))[0]
+    if user_input.endswith(".txt"):
+        with open(user_input, "r", encoding="utf-8") as file:
+            transcription = file.read()
+    elif user_input.endswith(".srt") or user_input.endswith(".vtt"):
+        transcription = convert_srt_vtt_to_text(user_input)
+    elif user_input.endswith(".ass"):
+        transcription = convert_ass_to_text(user_input)
     else:
-        model = "gpt-4o-mini"
-    task_hint = f'take the well-structured notes (in sequence) including all the detail information (especially the numeric data) \
+        transcription, notes = take_notes_from_audio(
+            user_input,
+            language,
+            api_token,
+            model_size=model_size,
+            model_name=model_name,
+            update_progress_bar=update_progress_bar,
+            logger=logger,
+            file_remove=False,
+            max_workers=max_workers,
+            journal=journal,
+            whisper_profile=whisper_profile,
+            compress=compress,
+            on_notes=on_notes,
+        )
+        return transcription, notes, title
+
+    notes = take_notes_chatgpt(
+        transcription,
+        language,
+        api_token,
+        model_name=model_name,
+        logger=logger,
+        max_workers=max_workers,
+        journal=journal,
+        compress=compress,
+        on_notes=on_notes,
+    )
+    return transcription, notes, title
+
+
+note_task_hint = 'take the well-structured notes (in sequence) including all the detail information (especially the numeric data) \
     in every knowledge point (especially arguments from both sides of the controversy) in the transcription. \
     (Format the structure with "- " for the topic, "* " for a detail information under its topic and \
     "** " for contents following by a ":" or a "?" or a list under a detail information, separate each topic with an empty line, \
     for example "- A \n* a: \n** b") \
     Please make sure the notes can cover all the sentences in the transcription. \
     You can take a long notes to the limit to your maxinum token.'
-    messages = [{"role": "system", "content": task_hint}]
-    user_chunks = split_text_by_token_limit_tiktoken(transcription, token_limit=1000)
-    notes = ""
 
-    for idx, chunk in enumerate(user_chunks):
-        messages.append({"role": "user", "content": chunk})
 
-        chatgpt_reply = client.chat.completions.create(model=model, messages=messages)
-        chatgpt_reply_msg = chatgpt_reply.choices[0].message.content
+# Notes longer than this are merged by reduce_notes_tree instead of being
+# translated in a single request
+tree_reduce_token_threshold = 12000
+
+
+# Bump whenever a prompt changes so cached replies to the old prompt are not replayed
+prompt_template_version = 2
+
+# Chat completion replies keyed by model, prompt version and message contents
+llm_cache = DiskCache("llm_responses", max_bytes=256 * 1024**2)
 
-        messages.append({"role": "assistant", "content": chatgpt_reply_msg})
-        messages.append(
-            {
-                "role": "system",
-                "content": "Following is the next part. Continue the task and try to append if there is obvious open ':' left in previous notes",
-            }
+
+def create_chat_completion(client, model, messages):
+    normalized = json.dumps(
+        [
+            [message["role"], " ".join(message["content"].split())]
+            for message in messages
+        ],
+        ensure_ascii=False,
+    )
+    cache_key = hash_key(model, prompt_template_version, normalized)
+    reply = llm_cache.get(cache_key)
+    if reply is not None:
+        logging.getLogger(__name__).debug("Replaying cached chat completion.")
+        return reply
+
+    chatgpt_reply = client.chat.completions.create(model=model, messages=messages)
+    reply = chatgpt_reply.choices[0].message.content
+    llm_cache.set(cache_key, reply)
+    return reply
+
+
+def get_gpt_model(model_name):
+    if model_name == "GPT-3.5-turbo":
+        return "gpt-3.5-turbo-0125"
+    elif model_name == "GPT-4o-mini":
+        return "gpt-4o-mini"
+    elif model_name == "GPT-4o":
+        return "gpt-4o"
+    else:
+        return "gpt-4o-mini"
+
+
+def merge_chunk_notes(replies):
+    # Chunks end at sentence boundaries, so every reply is kept whole
+    return "\n".join(reply.strip("\n") for reply in replies)
+
+
+def take_notes_chatgpt(
+    transcription,
+    language,
+    api_token,
+    model_name="GPT-4o-mini",
+    save_reply=False,
+    logger=None,
+    max_workers=1,
+    tree_reduce=None,
+    journal=None,
+    compress=True,
+    on_notes=None,
+):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    segments = journal.get("segments") if journal is not None else None
+    if segments is not None and "".join(segments) == transcription:
+        # Transcribed by take_notes_from_audio, whose chunks are rebuilt so the
+        # chunk notes of the failed run are reused
+        user_chunks = chunk_segments(segments, language, compress, logger=logger)
+    else:
+        if compress:
+            tokens_before = count_tokens(transcription)
+            transcription = compress_transcript(
+                transcription, language_dict[language][0]
+            )
+            log_compression(tokens_before, count_tokens(transcription), logger)
+        user_chunks = split_text_by_token_limit_tiktoken(
+            transcription, token_limit=1000
         )
+    return take_notes_from_chunks(
+        user_chunks,
+        language,
+        api_token,
+        model_name=model_name,
+        save_reply=save_reply,
+        logger=logger,
+        max_workers=max_workers,
+        tree_reduce=tree_reduce,
+        journal=journal,
+        on_notes=on_notes,
+    )
+
+
+def get_note_task_hint(language):
+    return f"{note_task_hint} Write the notes in {language}."
+
+
+continue_task_hint = "The transcription comes in parts, one per message. \
+    When the notes so far are given, continue them: do not repeat their topics, and append to an open ':' \
+    the previous notes ended with."
+
+
+class NoteContext:
+    """Context of the serial note-taking requests within a token budget.
+
+    Every request starts with the same system prompt, so the provider can cache
+    it as a prefix. The parts before the current chunk are carried as an outline
+    of the notes so far (their "- " topics, newest first to go into the budget)
+    and the end of the last reply, not as the earlier chunks and replies.
+    """
+
+    def __init__(self, language, token_budget=600, tail_tokens=200):
+        self.system_prompt = f"{get_note_task_hint(language)} {continue_task_hint}"
+        self.token_budget = token_budget
+        self.tail_tokens = tail_tokens
+        self.topics = []  # (line, token_count)
+        self.tail = ""
 
-        if len(messages) > 9:
-            messages.pop(1)
-            messages.pop(1)
-            messages.pop(1)
+    def add_reply(self, reply):
+        for line in reply.splitlines():
+            if line.startswith("- "):
+                self.topics.append((line, count_tokens(line)))
+        self.tail = get_tail_by_token_limit(reply.strip(), self.tail_tokens)
+
+    def outline(self):
+        budget = self.token_budget - count_tokens(self.tail)
+        lines = []
+        for line, token_count in reversed(self.topics):
+            if line in self.tail:
+                continue
+            if token_count > budget:
+                break
+            lines.append(line)
+            budget -= token_count
+        return "\n".join(reversed(lines))
+
+    def messages(self, chunk):
+        messages = [{"role": "system", "content": self.system_prompt}]
+        if self.tail:
+            messages.append(
+                {
+                    "role": "user",
+                    "content": f"Notes so far (outline):\n{self.outline()}\n\nThe previous notes ended with:\n{self.tail}",
+                }
+            )
+        messages.append({"role": "user", "content": chunk})
+        return messages
+
+
+def take_chunk_notes_serial(
+    client,
+    model,
+    user_chunks,
+    language,
+    save_reply=False,
+    logger=None,
+    journal=None,
+    token_budget=600,
+    on_notes=None,
+):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if journal is None:
+        journal = JobJournal()
+    done_notes = journal.get_chunk_notes()
+    context = NoteContext(language, token_budget=token_budget)
+    replies = []
+
+    for index, chunk in enumerate(user_chunks, start=1):
+        chunk_key = hash_key(chunk)
+        chatgpt_reply_msg = done_notes.get(chunk_key)
+        if chatgpt_reply_msg is None:
+            messages = context.messages(chunk)
+            input_tokens = sum(count_tokens(message["content"]) for message in messages)
+            journal.check_cancelled()
+            request_start = time.perf_counter()
+            chatgpt_reply_msg = create_chat_completion(client, model, messages)
+            logger.info(
+                f"Chunk {index}: {input_tokens} input tokens, "
+                f"{time.perf_counter() - request_start:.1f}s"
+            )
+            journal.add_chunk_notes(chunk_key, chatgpt_reply_msg)
+        if on_notes is not None:
+            on_notes(chatgpt_reply_msg + "\n")
+        context.add_reply(chatgpt_reply_msg)
 
         if save_reply:
             with open("conversation.txt", "a", encoding="utf-8") as file:
-                for index, line in enumerate(messages, start=1):
-                    if line["role"] == "assistant":
-                        file.write(f"{index}. {line}\n\n")
+                file.write(f"{index}. {chatgpt_reply_msg}\n\n")
 
-        if idx == 0:
-            notes += chatgpt_reply_msg
-        else:
-            notes += "\n".join(chatgpt_reply_msg.split("\n")[1:])
-            
-    messages = [{"role": "system", "content": f"Translate to {language}."}]
-    messages.append({"role": "user", "content": notes})
+        replies.append(chatgpt_reply_msg)
 
-    chatgpt_reply = client.chat.completions.create(model=model, messages=messages)
-    translated_notes = chatgpt_reply.choices[0].message.content
+    return replies
+
+
+def take_chunk_notes_parallel(
+    client,
+    model,
+    user_chunks,
+    language,
+    max_workers=4,
+    overlap_tokens=200,
+    save_reply=False,
+    logger=None,
+    journal=None,
+    on_notes=None,
+):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if journal is None:
+        journal = JobJournal()
+    done_notes = journal.get_chunk_notes()
+    latencies = []
+    output_tokens = []
+
+    def request(chunk, context):
+        # Without the serial conversation, the tail of the previous chunk stands
+        # in as context so the notes continue where the last chunk stopped
+        messages = [{"role": "system", "content": get_note_task_hint(language)}]
+        if context:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"For context only (do not take notes of it), the previous part of the transcription ended with: {context}",
+                }
+            )
+        messages.append({"role": "user", "content": chunk})
+
+        journal.check_cancelled()
+        request_start = time.perf_counter()
+        chatgpt_reply_msg = create_chat_completion(client, model, messages)
+        latencies.append(time.perf_counter() - request_start)
+        output_tokens.append(count_tokens(chatgpt_reply_msg))
+        journal.add_chunk_notes(hash_key(chunk), chatgpt_reply_msg)
+        return chatgpt_reply_msg
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        replies = []
+
+        def collect(wait=False):
+            # Replies are passed on in order, each once the ones before are done
+            while len(replies) < len(futures):
+                reply = futures[len(replies)]
+                if not isinstance(reply, str):
+                    if not (wait or reply.done()):
+                        return
+                    reply = reply.result()
+                replies.append(reply)
+                if on_notes is not None:
+                    on_notes(reply + "\n")
+
+        previous_chunk = None
+        for chunk in user_chunks:
+            context = ""
+            if previous_chunk is not None:
+                context = get_tail_by_token_limit(previous_chunk, overlap_tokens)
+            previous_chunk = chunk
+            chunk_notes = done_notes.get(hash_key(chunk))
+            if chunk_notes is not None:
+                futures.append(chunk_notes)
+            else:
+                futures.append(executor.submit(request, chunk, context))
+            collect()
+        collect(wait=True)
+    elapsed = time.perf_counter() - start
+
+    if save_reply:
+        with open("conversation.txt", "a", encoding="utf-8") as file:
+            for index, reply in enumerate(replies, start=1):
+                file.write(f"{index}. {reply}\n\n")
+
+    # Chunks resumed from the journal made no request
+    if latencies:
+        logger.info(
+            "Parallel note-taking: %d chunks in %.1fs with %d workers "
+            "(%.2f chunks/s, %.0f output tokens/s), "
+            "request latency mean %.1fs, max %.1fs",
+            len(latencies),
+            elapsed,
+            max_workers,
+            len(latencies) / elapsed,
+            sum(output_tokens) / elapsed,
+            sum(latencies) / len(latencies),
+            max(latencies),
+        )
+    return replies
+
+
+def translate_notes(client, model, notes, language, token_limit=2000, max_workers=4):
+    # Translate topic by topic in parallel instead of one full-length request
+    batches = group_texts_by_token_limit(notes.split("\n\n"), token_limit=token_limit)
+
+    def translate(batch):
+        messages = [
+            {"role": "system", "content": f"Translate to {language}."},
+            {"role": "user", "content": "\n\n".join(batch)},
+        ]
+        return create_chat_completion(client, model, messages)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return "\n\n".join(executor.map(translate, batches))
+
+
+def reduce_notes_tree(
+    client,
+    model,
+    notes_list,
+    language,
+    token_limit=3000,
+    max_workers=4,
+    logger=None,
+):
+    # Merge consecutive notes level by level (chunk -> section -> ...) until
+    # one document is left, so no single request grows with the length of the
+    # transcription. Sections too long to fit in token_limit with their
+    # neighbour are merged in pairs.
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    merge_hint = f'Merge the following consecutive parts of notes into one well-structured notes in {language}. \
+    Keep the sequence and all the detail information (especially the numeric data), remove only repeated points. \
+    Keep the format with "- " for the topic, "* " for a detail information under its topic and "** " for the contents under a detail information.'
+
+    def merge(batch):
+        messages = [
+            {"role": "system", "content": merge_hint},
+            {"role": "user", "content": "\n\n".join(batch)},
+        ]
+        return create_chat_completion(client, model, messages)
+
+    def merge_section(batch):
+        return batch[0] if len(batch) == 1 else merge(batch)
+
+    level = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The first level always runs so every chunk's notes end up in language
+        while level == 0 or len(notes_list) > 1:
+            batches = group_texts_by_token_limit(notes_list, token_limit=token_limit)
+            if level > 0 and len(batches) == len(notes_list):
+                batches = [notes_list[i : i + 2] for i in range(0, len(notes_list), 2)]
+            level += 1
+            logger.info(
+                f"Merging {len(notes_list)} notes into {len(batches)} (level {level})"
+            )
+            notes_list = list(
+                executor.map(merge if level == 1 else merge_section, batches)
+            )
 
+    return "\n\n".join(notes_list)
+
+
+def take_notes_from_chunks(
+    user_chunks,
+    language,
+    api_token,
+    model_name="GPT-4o-mini",
+    save_reply=False,
+    logger=None,
+    max_workers=1,
+    tree_reduce=None,
+    journal=None,
+    on_notes=None,
+):
+    # on_notes(text) gets the notes of each chunk, in order, once they are in
+    # the journal. They are then final, so neither merged by reduce_notes_tree
+    # nor translated.
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if journal is None:
+        journal = JobJournal()
+    if journal.get("notes") is not None:
+        return journal.get("notes")
+    if save_reply:
+        with open("conversation.txt", "w", encoding="utf-8") as file:
+            pass
+
+    client = get_openai_client(api_token)
+    logging.getLogger("openai").setLevel(logging.ERROR)
+    model = get_gpt_model(model_name)
+
+    if max_workers > 1:
+        replies = take_chunk_notes_parallel(
+            client,
+            model,
+            user_chunks,
+            language,
+            max_workers=max_workers,
+            save_reply=save_reply,
+            logger=logger,
+            journal=journal,
+            on_notes=on_notes,
+        )
+    else:
+        replies = take_chunk_notes_serial(
+            client,
+            model,
+            user_chunks,
+            language,
+            save_reply=save_reply,
+            logger=logger,
+            journal=journal,
+            on_notes=on_notes,
+        )
+    journal.check_cancelled()
+
+    if on_notes is not None:
+        tree_reduce = False
+    elif tree_reduce is None:
+        tree_reduce = (
+            count_tokens(merge_chunk_notes(replies)) > tree_reduce_token_threshold
+        )
+    if tree_reduce:
+        translated_notes = reduce_notes_tree(
+            client,
+            model,
+            replies,
+            language,
+            max_workers=max(max_workers, 4),
+            logger=logger,
+        )
+        journal.set("notes", translated_notes)
+        logger.info("Note-taking process completed.")
+        return translated_notes
+
+    notes = merge_chunk_notes(replies)
+
+    # The notes are already asked for in language, so only translate when the
+    # model ignored that (e.g. an English transcription with a CJK target)
+    if is_in_language(notes, language):
+        translated_notes = notes
+    elif on_notes is not None:
+        logger.warning(f"Notes are not in {language}, streamed notes are kept as is.")
+        translated_notes = notes
+    else:
+        logger.info(f"Notes are not in {language}, translating....")
+        translated_notes = translate_notes(
+            client, model, notes, language, max_workers=max(max_workers, 4)
+        )
+
+    journal.set("notes", translated_notes)
     logger.info("Note-taking process completed.")
     return translated_notes
 
 
 def create_notes_notion(
-    notes, title, youtube_url, notion_api_token, database_id, logger=None
+    notes,
+    title,
+    youtube_url,
+    notion_api_token,
+    database_id,
+    logger=None,
+    journal=None,
 ):
+    # Returns the page id once every block is on the page, otherwise None
     if logger is None:
         logger = logging.getLogger(__name__)
+    if journal is None:
+        journal = JobJournal()
 
-    url = "https://api.notion.com/v1/pages"
+    client = get_notion_client(notion_api_token, logger=logger)
 
-    headers = {
-        "Authorization": f"Bearer {notion_api_token}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
+    blocks = parse_input(notes)
+    properties = {
+        "Name": {"title": [{"type": "text", "text": {"content": title}}]},
+        "Link": {"url": youtube_url},
     }
 
-    property_name = "Link"
-    if not check_property_exists(database_id, property_name, headers):
-        add_property_to_database(database_id, property_name, "url", headers)
+    def record_progress(page_id, appended, overflow):
+        journal.set(
+            "notion_page", {"id": page_id, "appended": appended, "overflow": overflow}
+        )
+        journal.check_cancelled()
+
+    notion_page = journal.get("notion_page")
+    if notion_page is None:
+        page_id = client.create_page(
+            database_id,
+            properties,
+            blocks,
+            required_properties={"Link": "url"},
+            on_progress=record_progress,
+        )
+    else:
+        page_id = notion_page["id"]
+        if notion_page["appended"] < len(blocks):
+            logger.info(
+                f"Resuming Notion page {page_id} after {notion_page['appended']} blocks"
+            )
+        overflow = notion_page.get("overflow", [])
+        if overflow:
+            # Children of blocks on the page, left out by the failed run
+            overflow = client.append_overflow(
+                overflow,
+                on_progress=lambda overflow: record_progress(
+                    page_id, notion_page["appended"], overflow
+                ),
+            )
+        if not overflow:
+            client.append_blocks(
+                page_id,
+                blocks[notion_page["appended"] :],
+                on_progress=lambda appended, overflow: record_progress(
+                    page_id, notion_page["appended"] + appended, overflow
+                ),
+            )
 
-    blocks = parse_input(notes)
+    notion_page = journal.get("notion_page")
+    if (
+        notion_page is None
+        or notion_page["appended"] < len(blocks)
+        or notion_page.get("overflow")
+    ):
+        return None
+    logger.info("Page created successfully!")
+    return page_id
 
-    data = {
-        "parent": {"database_id": database_id},
-        "properties": {
-            "Name": {"title": [{"type": "text", "text": {"content": title}}]},
-            "Link": {"url": youtube_url},
-        },
-        "children": blocks[:99],
-    }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+class NotionNotesStream:
+    """Builds the Notion page while the notes are being written.
 
-    def append_apge(page_id, append_data):
-        append_block_url = f"https://api.notion.com/v1/blocks/{page_id}/children"
-        append_data = {"children": append_data[:99]}
-        response = requests.patch(
-            append_block_url, headers=headers, data=json.dumps(append_data)
-        )
-        if response.status_code == 200:
-            if len(append_data) > 99:
-                append_apge(page_id, append_data[99:])
-        else:
-            logger.error(
-                "Failed to append page. Status code: %d. Response: %s",
-                response.status_code,
-                response.text,
+    Its feed() is the on_notes of the note-taking functions, which pass on
+    each chunk's notes once they are journaled, so the page only has notes a
+    resumed job writes again word for word. The page is created with the
+    first chunk's notes and the next blocks are appended in batches, on one
+    background thread so the notes never wait for Notion. Progress goes to
+    the journal as in create_notes_notion, which appends whatever the stream
+    did not once the notes are done.
+    """
+
+    def __init__(
+        self,
+        title,
+        url,
+        notion_api_token,
+        database_id,
+        batch_size=20,
+        logger=None,
+        journal=None,
+    ):
+        self.logger = logger or logging.getLogger(__name__)
+        self.journal = journal if journal is not None else JobJournal()
+        self.client = get_notion_client(notion_api_token, logger=self.logger)
+        self.title = title
+        self.url = url
+        self.database_id = database_id
+        self.batch_size = batch_size
+        self.parser = NotesParser()
+        self.pending = []
+        self.submitted = False
+        self.failed = False
+        # A resumed job writes the same notes again, skip what is on the page
+        notion_page = self.journal.get("notion_page")
+        self.page_id = notion_page["id"] if notion_page else None
+        self.appended = notion_page["appended"] if notion_page else 0
+        self.overflow = notion_page.get("overflow", []) if notion_page else []
+        self.skip = self.appended
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def feed(self, text):
+        self._add(self.parser.feed(text))
+        if self.pending and (
+            not self.submitted or len(self.pending) >= self.batch_size
+        ):
+            self._flush()
+
+    def close(self, complete=True):
+        # Returns once every block has been sent. Notes that stopped early
+        # only send their finished blocks, the resumed job writes an open
+        # bullet again in full.
+        if complete:
+            self._add(self.parser.close())
+        if self.pending:
+            self._flush()
+        self.executor.shutdown(wait=True)
+
+    def _add(self, blocks):
+        skipped = min(self.skip, len(blocks))
+        self.skip -= skipped
+        self.pending += blocks[skipped:]
+
+    def _flush(self):
+        blocks, self.pending = self.pending, []
+        self.submitted = True
+        self.executor.submit(self._upload, blocks)
+
+    def _upload(self, blocks):
+        if self.failed:
+            return
+        start = self.appended
+
+        def record_progress(page_id, appended, overflow):
+            self.page_id = page_id
+            self.appended = start + appended
+            self.overflow = overflow
+            self.journal.set(
+                "notion_page",
+                {"id": page_id, "appended": self.appended, "overflow": overflow},
             )
 
-    if response.status_code == 200:
-        response_data = response.json()
-        if len(blocks) > 99:
-            page_id = response_data["id"]
-            append_apge(page_id, blocks[99:])
-        logger.info("Page created successfully!")
-    else:
-        logger.error(
-            "Failed to create page. Status code: %d. Response: %s",
-            response.status_code,
-            response.text,
+        try:
+            if self.overflow:
+                # Left by a failed run, under blocks already on the page
+                self.client.append_overflow(
+                    self.overflow,
+                    on_progress=lambda overflow: record_progress(
+                        self.page_id, 0, overflow
+                    ),
+                )
+                if self.overflow:
+                    self.failed = True
+                    return
+            if self.page_id is None:
+                # A URL's title is only known once its info is extracted
+                title = self.journal.get("title") or self.title
+                properties = {
+                    "Name": {"title": [{"type": "text", "text": {"content": title}}]},
+                    "Link": {"url": self.url},
+                }
+                page_id = self.client.create_page(
+                    self.database_id,
+                    properties,
+                    blocks,
+                    required_properties={"Link": "url"},
+                    on_progress=record_progress,
+                )
+                if page_id is not None:
+                    self.logger.info("Notion page created, adding the notes....")
+            else:
+                page_id = self.page_id
+                self.client.append_blocks(
+                    page_id,
+                    blocks,
+                    on_progress=lambda appended, overflow: record_progress(
+                        page_id, appended, overflow
+                    ),
+                )
+        except Exception:
+            self.logger.error("Failed to stream the notes to Notion", exc_info=True)
+        if self.appended < start + len(blocks) or self.overflow:
+            # The rest is left to create_notes_notion
+            self.failed = True
+
+
+def get_job_journal(job, setting, logger=None):
+    # Same input and options resume the last unfinished run
+    return JobJournal.for_job(
+        job["input"],
+        job.get("language", setting.get("language", "English")),
+        job.get("whisper_model", setting.get("whisper_model", "medium")),
+        job.get("gpt_model", setting.get("gpt_model", "GPT-4o-mini")),
+        setting.get("database_id", ""),
+        logger=logger,
+    )
+
+
+def run_job(job, setting, update_progress_bar=None, logger=None, journal=None):
+    # Runs one job end to end. job holds "input" and optionally "language",
+    # "whisper_model", "whisper_profile", "gpt_model", "compress_transcript"
+    # and "stream_notes", falling back to setting (the same keys as
+    # setting.json). Returns a result dict with per-stage timings. Pass a
+    # journal from get_job_journal to be able to cancel the job.
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    user_input = job["input"]
+    language = job.get("language", setting.get("language", "English"))
+    whisper_model = job.get("whisper_model", setting.get("whisper_model", "medium"))
+    whisper_profile = job.get(
+        "whisper_profile", setting.get("whisper_profile", "balanced")
+    )
+    gpt_model = job.get("gpt_model", setting.get("gpt_model", "GPT-4o-mini"))
+    compress = job.get("compress_transcript", setting.get("compress_transcript", True))
+    stream_notes = job.get("stream_notes", setting.get("stream_notes", False))
+    database_id = setting.get("database_id", "")
+    if journal is None:
+        journal = get_job_journal(job, setting, logger=logger)
+
+    result = {
+        "input": user_input,
+        "language": language,
+        "whisper_model": whisper_model,
+        "gpt_model": gpt_model,
+        "status": "failed",
+        "title": None,
+        "page_id": None,
+        "error": None,
+        "timings": {},
+    }
+    start = time.perf_counter()
+    try:
+        notes_stream = None
+        if stream_notes:
+            notes_stream = NotionNotesStream(
+                os.path.splitext(os.path.basename(user_input))[0],
+                user_input,
+                setting.get("notion_api", ""),
+                database_id,
+                logger=logger,
+                journal=journal,
+            )
+        try:
+            transcription, notes, title = take_notes_from_input(
+                user_input,
+                language,
+                setting.get("chatgpt_api", ""),
+                model_size=whisper_model,
+                model_name=gpt_model,
+                update_progress_bar=update_progress_bar,
+                logger=logger,
+                max_workers=setting.get("gpt_workers", 1),
+                journal=journal,
+                whisper_profile=whisper_profile,
+                compress=compress,
+                on_notes=None if notes_stream is None else notes_stream.feed,
+            )
+        except BaseException:
+            if notes_stream is not None:
+                notes_stream.close(complete=False)
+            raise
+        if notes_stream is not None:
+            notes_stream.close()
+        result["title"] = title
+        result["timings"]["notes"] = round(time.perf_counter() - start, 2)
+
+        notion_start = time.perf_counter()
+        page_id = create_notes_notion(
+            notes,
+            title,
+            user_input,
+            setting.get("notion_api", ""),
+            database_id,
+            logger=logger,
+            journal=journal,
         )
+        result["timings"]["notion"] = round(time.perf_counter() - notion_start, 2)
+        if page_id is None:
+            result["error"] = "Failed to create Notion page, retry to resume."
+        else:
+            journal.finish()
+            result["page_id"] = page_id
+            result["status"] = "completed"
+    except JobCancelled as e:
+        logger.info(f"Job cancelled: {user_input}")
+        result["status"] = "cancelled"
+        result["error"] = str(e)
+    except Exception as e:
+        logger.error(f"Job failed: {user_input}", exc_info=True)
+        result["error"] = str(e)
+
+    result["timings"]["total"] = round(time.perf_counter() - start, 2)
+    return result
@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from cache import CACHE_DIR, hash_key
+
+
+JOBS_DIR = os.path.join(CACHE_DIR, "jobs")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobJournal:
+    """Records the output of each pipeline stage so a failed job can resume.
+
+    Stages are stored one JSON file each under JOBS_DIR/<job_id>. Per-chunk
+    notes are appended to a JSON lines file as they arrive, keyed by a hash of
+    the chunk, so a resumed job has to rebuild the same chunks to reuse them.
+    A journal without a job_id only keeps the stages in memory.
+
+    The journal also carries the job's cancellation flag: the stages call
+    check_cancelled() between segments, requests and uploads, and a cancelled
+    job keeps its journal so it resumes when submitted again.
+    """
+
+    def __init__(self, job_id=None, logger=None):
+        self.job_id = job_id
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = os.path.join(JOBS_DIR, job_id) if job_id else None
+        self._stages = {}
+        self._chunk_notes = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        if self.path and os.path.isdir(self.path):
+            self._load()
+
+    @classmethod
+    def for_job(cls, *parts, logger=None):
+        return cls(hash_key(*parts)[:16], logger=logger)
+
+    def _load(self):
+        for file_name in os.listdir(self.path):
+            stage, ext = os.path.splitext(file_name)
+            file_path = os.path.join(self.path, file_name)
+            with open(file_path, "r", encoding="utf-8") as file:
+                if ext == ".json":
+                    self._stages[stage] = json.load(file)
+                elif ext == ".jsonl":
+                    for line in file:
+                        # A line cut short by a crash is simply redone
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        self._chunk_notes[record["chunk"]] = record["notes"]
+        if self._stages or self._chunk_notes:
+            done = ", ".join(self._stages) or "chunk notes"
+            self.logger.info(f"Resuming job {self.job_id} after: {done}")
+
+    def get(self, stage, default=None):
+        return self._stages.get(stage, default)
+
+    def set(self, stage, value):
+        with self._lock:
+            self._stages[stage] = value
+            if self.path is None:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            file_path = os.path.join(self.path, f"{stage}.json")
+            with open(file_path + ".tmp", "w", encoding="utf-8") as file:
+                json.dump(value, file, ensure_ascii=False)
+            os.replace(file_path + ".tmp", file_path)
+
+    def get_chunk_notes(self):
+        return dict(self._chunk_notes)
+
+    def add_chunk_notes(self, chunk_key, notes):
+        with self._lock:
+            self._chunk_notes[chunk_key] = notes
+            if self.path is None:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            with open(
+                os.path.join(self.path, "chunk_notes.jsonl"), "a", encoding="utf-8"
+            ) as file:
+                file.write(
+                    json.dumps({"chunk": chunk_key, "notes": notes}, ensure_ascii=False)
+                    + "\n"
+                )
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled("Job cancelled.")
+
+    def finish(self):
+        with self._lock:
+            if self.path is not None:
+                shutil.rmtree(self.path, ignore_errors=True)
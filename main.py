@@ -3,13 +3,13 @@ import logging
 import customtkinter as ctk
 from PIL import Image
 import json
-from core_func import (
-    get_transcription_from_url,
-    get_transcription_from_audio,
-    take_notes_chatgpt,
-    create_notes_notion,
-)
-from utils import resource_path, convert_srt_vtt_to_text, convert_ass_to_text
+import queue
+import threading
+import multiprocessing
+import requests
+from core_func import run_job, get_job_journal
+from client import JobClient, server_can_read
+from utils import resource_path, whisper_model_cache, whisper_profiles
 import os
 
 ctk.set_appearance_mode("System")
@@ -17,16 +17,7 @@ ctk.set_default_color_theme("blue")
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
 
-# Configure the logger
 log_file = "app_log.txt"
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file, mode="w"),
-        logging.StreamHandler(sys.stdout),
-    ],
-)
 logger = logging.getLogger(__name__)
 
 if getattr(sys, "frozen", False):
@@ -37,7 +28,7 @@ class App(ctk.CTk):
     def __init__(self):
         super().__init__()
         self.title("Note-Taker")
-        self.geometry("450x320")
+        self.geometry("450x400")
         self.resizable(False, False)
         self.iconbitmap(resource_path("./assets/Note-Taker.ico"))
 
@@ -49,12 +40,29 @@ class App(ctk.CTk):
         )  # Update this path to your settings icon image file
         self.setting_icon = ctk.CTkImage(Image.open(self.setting_icon_path))
 
+        # Jobs run one at a time on a worker thread. It only talks to the GUI
+        # through the events queue, which the Tk main loop polls.
+        self.jobs = []
+        self.current_job = None
+        self.job_queue = queue.Queue()
+        self.events = queue.Queue()
+        threading.Thread(target=self.run_jobs, daemon=True).start()
+
         self.setting = self.load_setting()
         if self.setting.get("chatgpt_api", "") and self.setting.get("notion_api", ""):
             self.main_interface()
         else:
             self.setting_interface()
 
+        self.after(60000, self.evict_idle_models)
+        self.after(100, self.poll_events)
+
+    def evict_idle_models(self):
+        # Free Whisper models left unused since the last job
+        if self.current_job is None:
+            whisper_model_cache.evict_idle(logger=logger)
+        self.after(60000, self.evict_idle_models)
+
     def save_setting(self, data):
         with open("setting.json", "w") as file:
             json.dump(data, file)
@@ -69,11 +77,9 @@ class App(ctk.CTk):
 
     def update_console_output(self, message):
         self.console_output.configure(text=message)
-        self.update_idletasks()
 
     def update_progress_bar(self, progress):
         self.progress_bar.set(progress)
-        self.progress_bar.update()
 
     def main_interface(self):
         for widget in self.main_frame.winfo_children():
@@ -86,6 +92,7 @@ class App(ctk.CTk):
         self.main_frame.grid_rowconfigure(4, weight=1)
         self.main_frame.grid_rowconfigure(5, weight=1, minsize=35)
         self.main_frame.grid_rowconfigure(6, weight=1, minsize=35)
+        self.main_frame.grid_rowconfigure(7, weight=1, minsize=70)
 
         setting = self.load_setting()
 
@@ -143,10 +150,19 @@ class App(ctk.CTk):
                 "Whisper API",
             ],
             width=150,
+            command=self.on_whisper_model_change,
         )
         self.opt_whisper.set(setting.get("whisper_model", "medium.en"))
         self.opt_whisper.grid(row=0, column=1, padx=10)
 
+        # Speed profile of the local Whisper models
+        self.opt_profile = ctk.CTkOptionMenu(
+            self.frame2, values=list(whisper_profiles), width=100
+        )
+        self.opt_profile.set(setting.get("whisper_profile", "balanced"))
+        self.opt_profile.grid(row=0, column=2, padx=0)
+        self.on_whisper_model_change(self.opt_whisper.get())
+
         # GPT model selection
         self.frame3 = ctk.CTkFrame(self.main_frame, fg_color="transparent")
         self.frame3.grid(row=3, column=0, pady=10, padx=20, sticky="w")
@@ -165,12 +181,22 @@ class App(ctk.CTk):
         self.take_notes_button = ctk.CTkButton(
             self.button_frame,
             text="Take Notes",
-            width=300,
+            width=220,
             height=30,
             command=self.take_notes,
         )
         self.take_notes_button.grid(row=0, column=0, padx=10)
 
+        self.cancel_button = ctk.CTkButton(
+            self.button_frame,
+            text="Cancel",
+            width=70,
+            height=30,
+            state="disabled",
+            command=self.cancel_job,
+        )
+        self.cancel_button.grid(row=0, column=1, padx=0)
+
         self.setting_button = ctk.CTkButton(
             self.button_frame,
             image=self.setting_icon,
@@ -179,7 +205,7 @@ class App(ctk.CTk):
             height=30,
             command=self.switch_to_setting,
         )
-        self.setting_button.grid(row=0, column=1, padx=10)
+        self.setting_button.grid(row=0, column=2, padx=10)
 
         # Create and hide the console output
         self.console_output = ctk.CTkLabel(
@@ -196,6 +222,17 @@ class App(ctk.CTk):
         self.progress_bar.grid_propagate(False)
         self.progress_bar.grid_remove()  # Hide the progress bar initially
 
+        # Running and queued jobs
+        self.jobs_label = ctk.CTkLabel(
+            self.main_frame, text="", anchor="nw", justify="left", width=400
+        )
+        self.jobs_label.grid(row=7, column=0, padx=20, pady=5, sticky="ew")
+
+    def on_whisper_model_change(self, model):
+        # The Whisper API has no local speed settings
+        state = "disabled" if model == "Whisper API" else "normal"
+        self.opt_profile.configure(state=state)
+
     def save_task_setting(self):
         self.setting = {
             "chatgpt_api": self.setting.get("chatgpt_api", ""),
@@ -203,103 +240,148 @@ class App(ctk.CTk):
             "database_id": self.setting.get("database_id", ""),
             "language": self.opt_lan.get(),
             "whisper_model": self.opt_whisper.get(),
+            "whisper_profile": self.opt_profile.get(),
             "gpt_model": self.opt_gpt.get(),
+            "gpt_workers": self.setting.get("gpt_workers", 1),
+            "compress_transcript": self.setting.get("compress_transcript", True),
+            "stream_notes": self.setting.get("stream_notes", False),
+            "server": self.setting.get("server", ""),
+            "server_token": self.setting.get("server_token", ""),
         }
         self.save_setting(self.setting)
 
     def take_notes(self):
-        # Disable buttons
-        self.take_notes_button.configure(state="disabled")
-        self.setting_button.configure(state="disabled")
-        self.entry1.configure(state="disabled")
-        self.opt_lan.configure(state="disabled")
-        self.opt_whisper.configure(state="disabled")
-        self.opt_gpt.configure(state="disabled")
-
+        user_input = self.entry1.get().strip()
+        if not user_input:
+            return
+        server = self.setting.get("server")
+        if server and not server_can_read(server, user_input):
+            self.update_console_output("The job server only takes URLs.")
+            return
+        self.save_task_setting()
+        job = {
+            "input": user_input,
+            "language": self.opt_lan.get(),
+            "whisper_model": self.opt_whisper.get(),
+            "whisper_profile": self.opt_profile.get(),
+            "gpt_model": self.opt_gpt.get(),
+        }
+        setting = dict(self.setting)
+        journal = get_job_journal(job, setting, logger=logger)
+        if any(entry["journal"].job_id == journal.job_id for entry in self.jobs):
+            self.update_console_output("This job is already queued.")
+            return
+
+        entry = {"job": job, "setting": setting, "journal": journal}
+        self.jobs.append(entry)
+        self.job_queue.put(entry)
+        self.entry1.delete(0, "end")
         self.console_output.grid()
         self.progress_bar.grid()
-        self.update_idletasks()
-
-        self.save_task_setting()
-        self.update_progress_bar(0)
-        try:
-            user_input = self.entry1.get()
-            if user_input.startswith("https"):
-                self.update_console_output(
-                    "Getting the transcription....                    "
-                )
-                logger.info("Getting the transcription...")
-                transcription, title = get_transcription_from_url(
-                    user_input,
-                    self.opt_lan.get(),
-                    self.opt_whisper.get(),
-                    api_token=self.setting.get("chatgpt_api", ""),
-                    update_progress_bar=self.update_progress_bar,
+        self.update_jobs()
+
+    def cancel_job(self):
+        if self.current_job is not None:
+            # Stops at the next Whisper segment, GPT request or Notion batch
+            self.current_job["journal"].cancel()
+            self.cancel_button.configure(state="disabled")
+            self.update_console_output("Cancelling....")
+
+    def run_jobs(self):
+        # Worker thread, never touches the widgets
+        while True:
+            entry = self.job_queue.get()
+            self.events.put(("start", entry))
+            last_progress = [0.0]
+
+            def update_progress_bar(progress, journal=entry["journal"]):
+                journal.check_cancelled()
+                # Whisper reports every segment, only send visible steps
+                if progress - last_progress[0] >= 0.01 or progress >= 1:
+                    last_progress[0] = progress
+                    self.events.put(("progress", progress))
+
+            logger.info(f"Taking notes for {entry['job']['input']}...")
+            if entry["setting"].get("server"):
+                result = self.run_remote_job(entry)
+            else:
+                result = run_job(
+                    entry["job"],
+                    entry["setting"],
+                    update_progress_bar=update_progress_bar,
                     logger=logger,
+                    journal=entry["journal"],
                 )
-            else:
-                title = os.path.splitext(os.path.basename(user_input))[0]
-                if user_input.endswith(".txt"):
-                    with open(user_input, "r", encoding="utf-8") as file:
-                        transcription = file.read()
-                elif user_input.endswith(".srt") or user_input.endswith(".vtt"):
-                    transcription = convert_srt_vtt_to_text(user_input)
-                elif user_input.endswith(".ass"):
-                    transcription = convert_ass_to_text(user_input)
-                else:
-                    self.update_console_output(
-                        "Getting the transcription....                    "
-                    )
-                    logger.info("Getting the transcription...")
-                    transcription = get_transcription_from_audio(
-                        user_input,
-                        self.opt_lan.get(),
-                        self.opt_whisper.get(),
-                        self.setting.get("chatgpt_api", ""),
-                        self.update_progress_bar,
-                        logger,
-                        file_remove=False,
-                    )
-
-            self.update_progress_bar(0.9)
-            self.update_console_output(
-                "Taking the notes by ChatGPT....                    "
-            )
-            logger.info("Taking the notes by ChatGPT...")
-            notes = take_notes_chatgpt(
-                transcription,
-                self.opt_lan.get(),
-                self.setting.get("chatgpt_api", ""),
-                model_name = self.opt_gpt.get(),
-                logger=logger,
-            )
+            self.events.put(("done", entry, result))
+
+    def run_remote_job(self, entry):
+        # With a "server" in setting.json the daemon does the work
+        setting = entry["setting"]
+        client = JobClient(setting["server"], token=setting.get("server_token"))
+        cancel_sent = [False]
+
+        def on_status(status):
+            if entry["journal"].is_cancelled() and not cancel_sent[0]:
+                client.cancel(status["id"])
+                cancel_sent[0] = True
+            self.events.put(("progress", status["progress"]))
+
+        try:
+            job_id = client.submit(entry["job"])
+            return client.wait(job_id, on_status=on_status)
+        except requests.RequestException as e:
+            logger.error("", exc_info=True)
+            return {"status": "failed", "error": str(e)}
+
+    def poll_events(self):
+        progress = None
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "progress":
+                # Only the latest progress of this poll is drawn
+                progress = event[1]
+            elif event[0] == "start":
+                self.current_job = event[1]
+                progress = 0
+                self.cancel_button.configure(state="normal")
+                self.update_console_output("Getting the transcription and notes....")
+                self.update_jobs()
+            elif event[0] == "done":
+                self.job_done(event[1], event[2])
+        if progress is not None:
+            self.update_progress_bar(progress)
+        self.after(100, self.poll_events)
+
+    def job_done(self, entry, result):
+        self.current_job = None
+        self.jobs.remove(entry)
+        self.cancel_button.configure(state="disabled")
+        if result["status"] == "completed":
             self.update_progress_bar(1)
-            self.update_console_output("Creating Notion page....                    ")
-            logger.info("Creating Notion page...")
-
-            create_notes_notion(
-                notes,
-                title,
-                user_input,
-                self.setting.get("notion_api", ""),
-                self.setting.get("database_id", ""),
-                logger=logger,
-            )
-            self.update_console_output(
-                "Note-taking process completed!                    "
-            )
+            self.update_console_output("Note-taking process completed!")
             logger.info("Note-taking process completed!")
-        except Exception as e:
-            self.update_console_output(str(e) + "                    ")
-            logger.error("", exc_info=True)
-
-        # Enable buttons
-        self.take_notes_button.configure(state="normal")
-        self.setting_button.configure(state="normal")
-        self.entry1.configure(state="normal")
-        self.opt_lan.configure(state="normal")
-        self.opt_whisper.configure(state="normal")
-        self.opt_gpt.configure(state="normal")
+        elif result["status"] == "cancelled":
+            self.update_console_output("Job cancelled, take notes again to resume.")
+        else:
+            self.update_console_output(result["error"])
+        self.update_jobs()
+
+    def update_jobs(self):
+        lines = []
+        for entry in self.jobs[:4]:
+            state = "Running" if entry is self.current_job else "Queued"
+            name = entry["job"]["input"]
+            if len(name) > 45:
+                name = "..." + name[-42:]
+            lines.append(f"{state}: {name}")
+        if len(self.jobs) > 4:
+            lines.append(f"and {len(self.jobs) - 4} more")
+        self.jobs_label.configure(text="\n".join(lines))
+        # The settings page replaces these widgets, so wait for the jobs
+        self.setting_button.configure(state="disabled" if self.jobs else "normal")
 
     def switch_to_setting(self):
         self.save_task_setting()
@@ -350,12 +432,29 @@ class App(ctk.CTk):
             "database_id": self.entry3.get(),
             "language": self.setting.get("language", "English"),
             "whisper_model": self.setting.get("whisper_model", "medium.en"),
+            "whisper_profile": self.setting.get("whisper_profile", "balanced"),
             "gpt_model": self.setting.get("gpt_model", "GPT-4o-mini"),
+            "gpt_workers": self.setting.get("gpt_workers", 1),
+            "compress_transcript": self.setting.get("compress_transcript", True),
+            "stream_notes": self.setting.get("stream_notes", False),
+            "server": self.setting.get("server", ""),
+            "server_token": self.setting.get("server_token", ""),
         }
         self.save_setting(self.setting)
         self.main_interface()
 
 
 if __name__ == "__main__":
+    # Whisper worker processes import this module again, so everything that
+    # must only happen once (like truncating the log) stays in here
+    multiprocessing.freeze_support()
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(log_file, mode="w"),
+            logging.StreamHandler(sys.stdout),
+        ],
+    )
     app = App()
     app.mainloop()
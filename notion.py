@@ -0,0 +1,359 @@
+import copy
+import time
+import logging
+import threading
+import email.utils
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+from cache import DiskCache
+
+
+NOTION_API_URL = "https://api.notion.com/v1/"
+NOTION_VERSION = "2022-06-28"
+
+# Limits of the Notion API
+MAX_BLOCKS_PER_REQUEST = 100
+MAX_BLOCK_ELEMENTS_PER_REQUEST = 1000
+MAX_RICH_TEXT_LENGTH = 2000
+REQUESTS_PER_SECOND = 3
+
+# Database properties ({name: type}) by database id, kept in memory and on disk
+schema_cache = DiskCache("notion_schema", max_bytes=4 * 1024**2, ttl=24 * 3600)
+_schemas = {}
+
+
+def split_rich_text(rich_text):
+    split = []
+    for item in rich_text:
+        content = item.get("text", {}).get("content")
+        if item.get("type") != "text" or content is None:
+            split.append(item)
+            continue
+        for start in range(0, max(len(content), 1), MAX_RICH_TEXT_LENGTH):
+            part = copy.deepcopy(item)
+            part["text"]["content"] = content[start : start + MAX_RICH_TEXT_LENGTH]
+            split.append(part)
+    return split
+
+
+def flatten_blocks(blocks):
+    flat = []
+    for block in blocks:
+        block = copy.deepcopy(block)
+        children = block[block["type"]].pop("children", [])
+        flat.append(block)
+        flat.extend(flatten_blocks(children))
+    return flat
+
+
+def prepare_block(block):
+    # Returns a copy of the block that fits in one request, plus the children
+    # that have to be appended to it once it exists. Blocks nested deeper than
+    # one level of children become siblings of their parent.
+    block = copy.deepcopy(block)
+    content = block[block["type"]]
+    children = flatten_blocks(content.pop("children", []))
+    for item in [block] + children:
+        item_content = item[item["type"]]
+        if "rich_text" in item_content:
+            item_content["rich_text"] = split_rich_text(item_content["rich_text"])
+    if children:
+        content["children"] = children[:MAX_BLOCKS_PER_REQUEST]
+    return block, children[MAX_BLOCKS_PER_REQUEST:]
+
+
+def batch_blocks(blocks):
+    # Yields (blocks, overflow children) batches within the per-request limits
+    batch, deferred, block_count = [], [], 0
+    for block in blocks:
+        block, overflow = prepare_block(block)
+        size = 1 + len(block[block["type"]].get("children", []))
+        if batch and (
+            len(batch) == MAX_BLOCKS_PER_REQUEST
+            or block_count + size > MAX_BLOCK_ELEMENTS_PER_REQUEST
+        ):
+            yield batch, deferred
+            batch, deferred, block_count = [], [], 0
+        batch.append(block)
+        deferred.append(overflow)
+        block_count += size
+    if batch:
+        yield batch, deferred
+
+
+def get_retry_delay(response, attempt):
+    # Retry-After is either seconds or an HTTP date
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return 2**attempt
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return 2**attempt
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class NotionConnection:
+    # The pooled session of a token and the pacing of its requests, shared by
+    # every client of the token
+    def __init__(self, token):
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        )
+        self.session.headers.update(
+            {
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json",
+                "Notion-Version": NOTION_VERSION,
+            }
+        )
+        self.rate_lock = threading.Lock()
+        self.next_request = 0.0
+
+    def wait_for_rate_limit(self):
+        with self.rate_lock:
+            now = time.monotonic()
+            delay = self.next_request - now
+            self.next_request = max(now, self.next_request) + 1 / REQUESTS_PER_SECOND
+        if delay > 0:
+            time.sleep(delay)
+
+
+class NotionClient:
+    def __init__(self, token, max_retries=5, logger=None, connection=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_retries = max_retries
+        self.connection = connection or NotionConnection(token)
+
+    def request(self, method, path, payload=None, idempotent=True):
+        # A request that is not idempotent is not retried on a server error,
+        # which may come after the change was made: a retry could create the
+        # page or the blocks twice. Rate limits and connection errors are
+        # always retried.
+        for attempt in range(self.max_retries + 1):
+            self.connection.wait_for_rate_limit()
+            try:
+                response = self.connection.session.request(
+                    method, NOTION_API_URL + path, json=payload, timeout=60
+                )
+            except requests.ConnectionError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = 2**attempt
+                self.logger.warning(
+                    f"Notion connection error, retrying in {delay}s: {e}"
+                )
+                time.sleep(delay)
+                continue
+
+            if response.status_code != 429 and (
+                response.status_code < 500 or not idempotent
+            ):
+                return response
+            if attempt == self.max_retries:
+                return response
+            delay = get_retry_delay(response, attempt)
+            self.logger.warning(
+                f"Notion returned {response.status_code}, retrying in {delay}s"
+            )
+            time.sleep(delay)
+
+    def get_database(self, database_id):
+        return self.request("GET", f"databases/{database_id}")
+
+    def update_database(self, database_id, properties):
+        return self.request(
+            "PATCH", f"databases/{database_id}", {"properties": properties}
+        )
+
+    def get_database_properties(self, database_id, refresh=False):
+        if not refresh:
+            properties = _schemas.get(database_id)
+            if properties is None:
+                properties = schema_cache.get(database_id)
+            if properties is not None:
+                _schemas[database_id] = properties
+                return properties
+
+        response = self.get_database(database_id)
+        if response.status_code != 200:
+            # Unknown is not the same as missing, do not patch on errors
+            self.logger.warning(
+                "Failed to get database schema: %d, %s",
+                response.status_code,
+                response.text,
+            )
+            return None
+        properties = {
+            name: prop["type"] for name, prop in response.json()["properties"].items()
+        }
+        _schemas[database_id] = properties
+        schema_cache.set(database_id, properties)
+        return properties
+
+    def invalidate_schema(self, database_id):
+        _schemas.pop(database_id, None)
+        schema_cache.delete(database_id)
+
+    def ensure_properties(self, database_id, required, refresh=False):
+        properties = self.get_database_properties(database_id, refresh=refresh)
+        if properties is None:
+            return False
+        missing = {
+            name: {"type": prop_type, prop_type: {}}
+            for name, prop_type in required.items()
+            if name not in properties
+        }
+        if not missing:
+            return True
+
+        # All missing properties go in a single schema patch
+        response = self.update_database(database_id, missing)
+        if response.status_code != 200:
+            self.logger.warning(
+                "Failed to add property to database: %d, %s",
+                response.status_code,
+                response.text,
+            )
+            return False
+        self.logger.info(f"Properties {list(missing)} added to the database.")
+        properties = {
+            name: prop["type"] for name, prop in response.json()["properties"].items()
+        }
+        _schemas[database_id] = properties
+        schema_cache.set(database_id, properties)
+        return True
+
+    def append_blocks(self, parent_id, blocks, on_progress=None):
+        # Appends must stay sequential to keep the order, so the batches go
+        # one after another over the same keep-alive connection.
+        # on_progress(appended, overflow) is called after each batch of
+        # top-level blocks, with the [parent id, children] pairs still to be
+        # appended beyond the per-block limit. A batch counts once it is on
+        # the page, so a resumed job only appends its missing overflow.
+        appended = 0
+        for batch, deferred in batch_blocks(blocks):
+            response = self.request(
+                "PATCH",
+                f"blocks/{parent_id}/children",
+                {"children": batch},
+                idempotent=False,
+            )
+            if response.status_code != 200:
+                self.logger.error(
+                    "Failed to append page. Status code: %d. Response: %s",
+                    response.status_code,
+                    response.text,
+                )
+                return appended
+            appended += len(batch)
+            overflow = [
+                [result["id"], children]
+                for result, children in zip(response.json()["results"], deferred)
+                if children
+            ]
+            if on_progress is not None:
+                on_progress(appended, overflow)
+            if overflow and self.append_overflow(
+                overflow,
+                on_progress=(
+                    None
+                    if on_progress is None
+                    else lambda overflow: on_progress(appended, overflow)
+                ),
+            ):
+                return appended
+        return appended
+
+    def append_overflow(self, overflow, on_progress=None):
+        # Appends the [parent id, children] pairs left by append_blocks and
+        # returns the pairs still missing, [] once all are on the page.
+        # on_progress(overflow) is called as each parent is done.
+        overflow = list(overflow)
+        while overflow:
+            parent_id, children = overflow[0]
+            appended = self.append_blocks(parent_id, children)
+            if appended < len(children):
+                overflow[0] = [parent_id, children[appended:]]
+                if on_progress is not None and appended:
+                    on_progress(overflow)
+                return overflow
+            overflow = overflow[1:]
+            if on_progress is not None:
+                on_progress(overflow)
+        return overflow
+
+    def create_page(
+        self,
+        database_id,
+        properties,
+        blocks,
+        required_properties=None,
+        on_progress=None,
+    ):
+        # Returns the page id, or None if the page could not be created.
+        # on_progress(page_id, appended, overflow) tracks how many blocks are
+        # on the page, see append_blocks.
+        first_batch, deferred = next(batch_blocks(blocks), ([], []))
+        if any(deferred):
+            # The page response has no block ids to append the overflow
+            # children to, so every block goes through append_blocks
+            first_batch = []
+        payload = {
+            "parent": {"database_id": database_id},
+            "properties": properties,
+            "children": first_batch,
+        }
+
+        if required_properties:
+            self.ensure_properties(database_id, required_properties)
+        response = self.request("POST", "pages", payload, idempotent=False)
+        if (
+            response.status_code == 400
+            and required_properties
+            and response.json().get("code") == "validation_error"
+        ):
+            # The cached schema may be stale, refresh it and try once more
+            self.invalidate_schema(database_id)
+            self.ensure_properties(database_id, required_properties, refresh=True)
+            response = self.request("POST", "pages", payload, idempotent=False)
+        if response.status_code != 200:
+            self.logger.error(
+                "Failed to create page. Status code: %d. Response: %s",
+                response.status_code,
+                response.text,
+            )
+            return None
+
+        page_id = response.json()["id"]
+        if on_progress is not None:
+            on_progress(page_id, len(first_batch), [])
+
+        def on_append(appended, overflow):
+            if on_progress is not None:
+                on_progress(page_id, len(first_batch) + appended, overflow)
+
+        self.append_blocks(page_id, blocks[len(first_batch) :], on_progress=on_append)
+        return page_id
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_notion_client(token, logger=None):
+    # One pooled session per token, shared by every page created in the
+    # process, and a client per caller so each job logs to its own logger
+    with _connections_lock:
+        if token not in _connections:
+            _connections[token] = NotionConnection(token)
+        connection = _connections[token]
+    return NotionClient(token, logger=logger, connection=connection)
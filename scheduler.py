@@ -0,0 +1,295 @@
+import os
+import time
+import queue
+import logging
+import threading
+from core_func import (
+    get_transcription_from_audio,
+    get_transcription_from_captions,
+    get_video_transcript_key,
+    get_cached_transcription,
+    transcript_cache,
+    take_notes_chatgpt,
+    create_notes_notion,
+    get_job_journal,
+    NotionNotesStream,
+)
+from utils import (
+    extract_video_info,
+    download_audio,
+    convert_srt_vtt_to_text,
+    convert_ass_to_text,
+)
+
+
+# Each stage waits on a different resource, so each gets its own workers:
+# network for downloads, GPU/CPU for Whisper, API latency for GPT and the
+# Notion rate limit for uploads
+default_stage_workers = {"download": 2, "transcribe": 1, "notes": 4, "upload": 1}
+
+
+class StageScheduler:
+    def __init__(self, setting, stage_workers=None, queue_size=2, logger=None):
+        self.setting = setting
+        self.logger = logger or logging.getLogger(__name__)
+        self.stage_workers = dict(default_stage_workers, **(stage_workers or {}))
+        self.stages = [
+            ("download", self.download),
+            ("transcribe", self.transcribe),
+            ("notes", self.take_notes),
+            ("upload", self.upload),
+        ]
+        # Bounded queues make a fast stage wait instead of piling up work
+        # (and downloaded audio) in front of a slow one
+        self.queues = {
+            name: queue.Queue(maxsize=queue_size) for name, _ in self.stages
+        }
+        self.stats = {
+            name: {"jobs": 0, "busy": 0.0, "waiting": 0.0} for name, _ in self.stages
+        }
+        self.results = []
+        self._lock = threading.Lock()
+        self._threads = []
+        self._live_workers = {}
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        for index, (name, func) in enumerate(self.stages):
+            self._live_workers[name] = self.stage_workers[name]
+            for _ in range(self.stage_workers[name]):
+                thread = threading.Thread(
+                    target=self._worker, args=(index, name, func), daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, job):
+        state = self._new_state(job)
+        self.queues[self.stages[0][0]].put(state)
+
+    def close(self):
+        first = self.stages[0][0]
+        for _ in range(self.stage_workers[first]):
+            self.queues[first].put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def run(self, jobs):
+        self.start()
+        for job in jobs:
+            self.submit(job)
+        self.close()
+        return self.results
+
+    def _worker(self, index, name, func):
+        next_queue = None
+        if index + 1 < len(self.stages):
+            next_queue = self.queues[self.stages[index + 1][0]]
+
+        while True:
+            state = self.queues[name].get()
+            if state is None:
+                break
+
+            if state["result"]["error"] is None:
+                start = time.perf_counter()
+                try:
+                    func(state)
+                except Exception as e:
+                    self.logger.error(
+                        f"Job failed at {name}: {state['job']['input']}",
+                        exc_info=True,
+                    )
+                    state["result"]["error"] = str(e)
+                elapsed = time.perf_counter() - start
+                state["result"]["timings"][name] = round(elapsed, 2)
+                with self._lock:
+                    self.stats[name]["jobs"] += 1
+                    self.stats[name]["busy"] += elapsed
+
+            if next_queue is None:
+                self._finish(state)
+                continue
+            wait_start = time.perf_counter()
+            next_queue.put(state)
+            with self._lock:
+                self.stats[name]["waiting"] += time.perf_counter() - wait_start
+
+        with self._lock:
+            self._live_workers[name] -= 1
+            last_worker = self._live_workers[name] == 0
+        if last_worker and next_queue is not None:
+            next_name = self.stages[index + 1][0]
+            for _ in range(self.stage_workers[next_name]):
+                next_queue.put(None)
+
+    def _finish(self, state):
+        result = state["result"]
+        if result["error"] is None:
+            result["status"] = "completed"
+            state["journal"].finish()
+        result["timings"]["total"] = round(time.perf_counter() - state["start"], 2)
+        with self._lock:
+            self.results.append(result)
+
+    def utilization(self):
+        elapsed = time.perf_counter() - self._start if self._start else 0.0
+        report = {}
+        for name, _ in self.stages:
+            stats = self.stats[name]
+            capacity = elapsed * self.stage_workers[name]
+            report[name] = {
+                "workers": self.stage_workers[name],
+                "jobs": stats["jobs"],
+                "busy": round(stats["busy"], 2),
+                # Time spent waiting for room in the next stage's queue
+                "blocked": round(stats["waiting"], 2),
+                "utilization": round(stats["busy"] / capacity, 3) if capacity else 0,
+            }
+        return report
+
+    def _new_state(self, job):
+        setting = self.setting
+        language = job.get("language", setting.get("language", "English"))
+        whisper_model = job.get(
+            "whisper_model", setting.get("whisper_model", "medium")
+        )
+        gpt_model = job.get("gpt_model", setting.get("gpt_model", "GPT-4o-mini"))
+        whisper_profile = job.get(
+            "whisper_profile", setting.get("whisper_profile", "balanced")
+        )
+        journal = get_job_journal(job, setting, logger=self.logger)
+        return {
+            "job": job,
+            "language": language,
+            "whisper_model": whisper_model,
+            "gpt_model": gpt_model,
+            "whisper_profile": whisper_profile,
+            "journal": journal,
+            "start": time.perf_counter(),
+            "title": None,
+            "transcription": journal.get("transcription"),
+            "audio_file": None,
+            "file_remove": False,
+            "cache_key": None,
+            "notes": None,
+            "result": {
+                "input": job["input"],
+                "language": language,
+                "whisper_model": whisper_model,
+                "gpt_model": gpt_model,
+                "status": "failed",
+                "title": None,
+                "page_id": None,
+                "error": None,
+                "timings": {},
+            },
+        }
+
+    def download(self, state):
+        user_input = state["job"]["input"]
+        journal = state["journal"]
+        if not user_input.startswith("https"):
+            state["title"] = os.path.splitext(os.path.basename(user_input))[0]
+            if state["transcription"] is not None:
+                return
+            if user_input.endswith(".txt"):
+                with open(user_input, "r", encoding="utf-8") as file:
+                    state["transcription"] = file.read()
+            elif user_input.endswith(".srt") or user_input.endswith(".vtt"):
+                state["transcription"] = convert_srt_vtt_to_text(user_input)
+            elif user_input.endswith(".ass"):
+                state["transcription"] = convert_ass_to_text(user_input)
+            else:
+                state["audio_file"] = user_input
+            return
+
+        info = extract_video_info(user_input, logger=self.logger)
+        state["title"] = info.get("title")
+        if state["transcription"] is not None:
+            return
+        state["transcription"] = get_transcription_from_captions(
+            user_input, state["language"], info, logger=self.logger
+        )
+        if state["transcription"] is not None:
+            return
+        state["cache_key"] = get_video_transcript_key(
+            info, state["language"], state["whisper_model"], state["whisper_profile"]
+        )
+        state["transcription"] = get_cached_transcription(
+            state["cache_key"], logger=self.logger
+        )
+        if state["transcription"] is not None:
+            return
+
+        audio_file = journal.get("audio_file")
+        if audio_file is None or not os.path.exists(audio_file):
+            audio_file = download_audio(user_input, logger=self.logger, info=info)
+            journal.set("audio_file", audio_file)
+        state["audio_file"] = audio_file
+        state["file_remove"] = True
+
+    def transcribe(self, state):
+        if state["transcription"] is None:
+            state["transcription"] = get_transcription_from_audio(
+                state["audio_file"],
+                state["language"],
+                state["whisper_model"],
+                self.setting.get("chatgpt_api", ""),
+                logger=self.logger,
+                file_remove=state["file_remove"],
+                whisper_profile=state["whisper_profile"],
+            )
+            if state["cache_key"] is not None:
+                transcript_cache.set(state["cache_key"], state["transcription"])
+        state["journal"].set("transcription", state["transcription"])
+
+    def take_notes(self, state):
+        job, setting = state["job"], self.setting
+        notes_stream = None
+        if job.get("stream_notes", setting.get("stream_notes", False)):
+            # The upload stage then only appends what the stream did not
+            notes_stream = NotionNotesStream(
+                state["title"] or os.path.splitext(os.path.basename(job["input"]))[0],
+                job["input"],
+                setting.get("notion_api", ""),
+                setting.get("database_id", ""),
+                logger=self.logger,
+                journal=state["journal"],
+            )
+        try:
+            state["notes"] = take_notes_chatgpt(
+                state["transcription"],
+                state["language"],
+                setting.get("chatgpt_api", ""),
+                model_name=state["gpt_model"],
+                logger=self.logger,
+                max_workers=setting.get("gpt_workers", 1),
+                journal=state["journal"],
+                compress=job.get(
+                    "compress_transcript", setting.get("compress_transcript", True)
+                ),
+                on_notes=None if notes_stream is None else notes_stream.feed,
+            )
+        except BaseException:
+            if notes_stream is not None:
+                notes_stream.close(complete=False)
+            raise
+        if notes_stream is not None:
+            notes_stream.close()
+
+    def upload(self, state):
+        state["result"]["title"] = state["title"]
+        page_id = create_notes_notion(
+            state["notes"],
+            state["title"],
+            state["job"]["input"],
+            self.setting.get("notion_api", ""),
+            self.setting.get("database_id", ""),
+            logger=self.logger,
+            journal=state["journal"],
+        )
+        if page_id is None:
+            raise RuntimeError("Failed to create Notion page, retry to resume.")
+        state["result"]["page_id"] = page_id
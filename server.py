@@ -0,0 +1,266 @@
+import hmac
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from core_func import run_job, get_job_journal
+from utils import whisper_model_cache
+from client import finished_statuses, is_loopback
+
+
+class JobService:
+    """Shared job queue of the note-taker daemon.
+
+    Jobs run on a fixed number of worker threads in this one process, so the
+    Whisper models, OpenAI and Notion clients stay loaded between jobs and
+    between the clients that submit them.
+    """
+
+    def __init__(self, setting, workers=1, max_finished=200, logger=None):
+        self.setting = setting
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_finished = max_finished
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._running = 0
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        threading.Thread(target=self._evict_idle_models, daemon=True).start()
+
+    def submit(self, job, allow_files=True):
+        # Files are read on this host, so only its own users may name them
+        if not isinstance(job, dict) or not isinstance(job.get("input"), str):
+            raise ValueError("A job needs an 'input' URL or file path.")
+        if not job["input"].startswith("https") and not allow_files:
+            raise ValueError("Only URLs can be submitted from another host.")
+        journal = get_job_journal(job, self.setting, logger=self.logger)
+        with self._lock:
+            # The same job twice would only race on one journal
+            for entry in self.jobs.values():
+                if (
+                    entry["journal"].job_id == journal.job_id
+                    and entry["status"] not in finished_statuses
+                ):
+                    return entry["id"]
+            entry = {
+                "id": uuid.uuid4().hex[:12],
+                "job": job,
+                "journal": journal,
+                "status": "queued",
+                "progress": 0.0,
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+                "result": None,
+            }
+            self.jobs[entry["id"]] = entry
+            self._prune()
+        self.queue.put(entry)
+        self.logger.info(f"Job {entry['id']} queued: {job['input']}")
+        return entry["id"]
+
+    def status(self, job_id):
+        entry = self.jobs.get(job_id)
+        if entry is None:
+            return None
+        with self._lock:
+            queued = [
+                other["id"]
+                for other in self.jobs.values()
+                if other["status"] == "queued"
+            ]
+        return {
+            "id": entry["id"],
+            "input": entry["job"]["input"],
+            "status": entry["status"],
+            "progress": round(entry["progress"], 3),
+            "position": queued.index(job_id) if job_id in queued else None,
+            "submitted": entry["submitted"],
+            "started": entry["started"],
+            "finished": entry["finished"],
+        }
+
+    def list(self):
+        return [self.status(job_id) for job_id in list(self.jobs)]
+
+    def cancel(self, job_id):
+        entry = self.jobs.get(job_id)
+        if entry is None:
+            return False
+        with self._lock:
+            if entry["status"] == "queued":
+                # Never started, so it is done as soon as it is cancelled
+                self._set_cancelled(entry)
+            elif entry["status"] == "running":
+                entry["journal"].cancel()
+        return True
+
+    def _set_cancelled(self, entry):
+        entry["journal"].cancel()
+        entry["result"] = {
+            "input": entry["job"]["input"],
+            "status": "cancelled",
+            "error": "Job cancelled.",
+        }
+        entry["finished"] = time.time()
+        entry["status"] = "cancelled"
+
+    def result(self, job_id):
+        entry = self.jobs.get(job_id)
+        return None if entry is None else entry["result"]
+
+    def _prune(self):
+        finished = [
+            entry
+            for entry in self.jobs.values()
+            if entry["status"] in finished_statuses
+        ]
+        for entry in finished[: max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[entry["id"]]
+
+    def _worker(self):
+        while True:
+            entry = self.queue.get()
+            journal = entry["journal"]
+            with self._lock:
+                if entry["status"] == "cancelled":
+                    continue
+                entry["status"] = "running"
+                entry["started"] = time.time()
+                self._running += 1
+
+            def update_progress_bar(progress, entry=entry):
+                entry["journal"].check_cancelled()
+                entry["progress"] = progress
+
+            try:
+                result = run_job(
+                    entry["job"],
+                    self.setting,
+                    update_progress_bar=update_progress_bar,
+                    logger=self.logger,
+                    journal=journal,
+                )
+            finally:
+                with self._lock:
+                    self._running -= 1
+            if result["status"] == "completed":
+                entry["progress"] = 1.0
+            entry["result"] = result
+            entry["status"] = result["status"]
+            entry["finished"] = time.time()
+            self.logger.info(f"Job {entry['id']} {result['status']}")
+
+    def _evict_idle_models(self):
+        while True:
+            time.sleep(60)
+            # A model in use may look idle during a long transcription
+            if self._running == 0:
+                whisper_model_cache.evict_idle(logger=self.logger)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs, GET /jobs, GET /jobs/<id>, POST /jobs/<id>/cancel,
+    # GET /jobs/<id>/result
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self._send(200, service.list())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            status = service.status(parts[1])
+            if status is None:
+                self._send(404, {"error": "Job not found."})
+            else:
+                self._send(200, status)
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result":
+            status = service.status(parts[1])
+            if status is None:
+                self._send(404, {"error": "Job not found."})
+            elif status["status"] not in finished_statuses:
+                self._send(409, {"error": f"Job is {status['status']}."})
+            else:
+                self._send(200, service.result(parts[1]))
+        else:
+            self._send(404, {"error": "Not found."})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = json.loads(self.rfile.read(length) or b"{}")
+                job_id = service.submit(
+                    job, allow_files=is_loopback(self.client_address[0])
+                )
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+                return
+            self._send(202, {"id": job_id})
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+            if service.cancel(parts[1]):
+                self._send(202, service.status(parts[1]))
+            else:
+                self._send(404, {"error": "Job not found."})
+        else:
+            self._send(404, {"error": "Not found."})
+
+    def _authorized(self):
+        token = self.server.token
+        authorization = self.headers.get("Authorization", "")
+        if token and not hmac.compare_digest(
+            authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8")
+        ):
+            self._send(401, {"error": "Unauthorized."})
+            return False
+        return True
+
+    def _send(self, status_code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format % args)
+
+
+def create_server(
+    setting, host="127.0.0.1", port=8765, workers=1, token=None, logger=None
+):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if not token and not is_loopback(host):
+        raise ValueError(f"Serving on {host} needs a token (--token).")
+    server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    server.daemon_threads = True
+    server.service = JobService(setting, workers=workers, logger=logger)
+    server.token = token
+    return server
+
+
+def serve(setting, host="127.0.0.1", port=8765, workers=1, token=None, logger=None):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    server = create_server(
+        setting, host=host, port=port, workers=workers, token=token, logger=logger
+    )
+    logger.info(f"Serving note-taking jobs on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
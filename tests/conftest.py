@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+
+# The caches and job journals of the tests never touch the real cache folder
+os.environ["NOTE_TAKER_CACHE_DIR"] = tempfile.mkdtemp(prefix="note-taker-test-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import utils
+import core_func
+
+
+class ByteEncoding:
+    # One token per UTF-8 byte, so token counts are known without tiktoken's
+    # BPE files (which are downloaded on first use)
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+    def decode_bytes(self, tokens):
+        return bytes(tokens)
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch):
+    encoding = ByteEncoding()
+    monkeypatch.setattr(utils, "get_encoding", lambda model="gpt-3.5-turbo": encoding)
+    return encoding
+
+
+class RecordingNotion:
+    # Keeps the blocks sent to Notion, every request succeeds
+    def __init__(self):
+        self.blocks = []
+
+    def create_page(self, database_id, properties, blocks, on_progress, **kwargs):
+        self.blocks += blocks
+        on_progress("page", len(blocks), [])
+        return "page"
+
+    def append_blocks(self, page_id, blocks, on_progress):
+        self.blocks += blocks
+        on_progress(len(blocks), [])
+        return len(blocks)
+
+
+@pytest.fixture
+def recording_notion(monkeypatch):
+    notion = RecordingNotion()
+    monkeypatch.setattr(
+        core_func, "get_notion_client", lambda token, logger=None: notion
+    )
+    return notion
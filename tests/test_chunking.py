@@ -0,0 +1,25 @@
+from utils import (
+    stream_text_by_token_limit_tiktoken,
+    split_text_by_token_limit_tiktoken,
+)
+
+
+def test_chunks_never_exceed_the_token_limit(byte_encoding):
+    texts = ["a" * 599 + ".", "b" * 380, "c" * 700]
+    chunks = list(stream_text_by_token_limit_tiktoken(texts, token_limit=1000))
+    assert all(len(chunk.encode("utf-8")) <= 1000 for chunk in chunks)
+    assert "".join(chunks) == "".join(texts)
+
+
+def test_chunks_end_at_sentences(byte_encoding):
+    sentence = "This sentence is forty bytes long, yes. "
+    chunks = split_text_by_token_limit_tiktoken(sentence * 10, token_limit=100)
+    assert chunks[:-1] == [sentence * 2] * 4
+    assert "".join(chunks) == sentence * 10
+
+
+def test_long_text_is_cut_between_characters(byte_encoding):
+    text = "中" * 100  # 300 bytes without a space or stop to cut at
+    chunks = split_text_by_token_limit_tiktoken(text, token_limit=100)
+    assert all(len(chunk.encode("utf-8")) <= 100 for chunk in chunks)
+    assert "".join(chunks) == text
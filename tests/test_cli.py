@@ -0,0 +1,75 @@
+import json
+import pytest
+from cli import load_manifest, main, parse_stage_workers
+
+
+def test_load_manifest_reports_entries_without_input(tmp_path):
+    manifest = tmp_path / "jobs.json"
+    manifest.write_text(
+        json.dumps(["talk.mp3", {"input": "lecture.mp4"}, {"language": "English"}, 3])
+    )
+    jobs, invalid = load_manifest(str(manifest))
+    assert jobs == [{"input": "talk.mp3"}, {"input": "lecture.mp4"}]
+    assert [result["status"] for result in invalid] == ["failed", "failed"]
+
+
+def test_run_writes_a_report_for_an_invalid_manifest(tmp_path):
+    manifest = tmp_path / "jobs.json"
+    manifest.write_text(json.dumps([{"language": "English"}]))
+    report_file = tmp_path / "report.json"
+    exit_code = main(
+        [
+            "run",
+            "--manifest",
+            str(manifest),
+            "--report",
+            str(report_file),
+            "--setting",
+            str(tmp_path / "setting.json"),
+        ]
+    )
+    report = json.loads(report_file.read_text())
+    assert exit_code == 1
+    assert report["total"] == 1 and report["failed"] == 1
+
+
+def test_run_reports_jobs_the_server_did_not_take(tmp_path):
+    report_file = tmp_path / "report.json"
+    exit_code = main(
+        [
+            "run",
+            "https://example.com/talk",
+            "talk.mp3",
+            "--server",
+            "http://127.0.0.1:9",
+            "--report",
+            str(report_file),
+            "--setting",
+            str(tmp_path / "setting.json"),
+        ]
+    )
+    report = json.loads(report_file.read_text())
+    assert exit_code == 1
+    assert report["total"] == 2 and report["failed"] == 2
+
+
+def test_parse_stage_workers_rejects_unknown_stages_and_empty_stages():
+    assert parse_stage_workers("download=2, notes=4") == {"download": 2, "notes": 4}
+    for stage_workers in ["notion=2", "transcribe=0", "notes=many", "upload"]:
+        with pytest.raises(ValueError):
+            parse_stage_workers(stage_workers)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--concurrency", "0"],
+        ["--concurrency", "-2"],
+        ["--gpt-workers", "0"],
+        ["--pipeline", "--stage-workers", "notes=0"],
+    ],
+)
+def test_run_rejects_worker_counts_below_1(tmp_path, options):
+    with pytest.raises(SystemExit) as error:
+        main(["run", "talk.mp3", "--setting", str(tmp_path / "setting.json")] + options)
+    assert error.value.code == 2
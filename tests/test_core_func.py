@@ -0,0 +1,273 @@
+from types import SimpleNamespace
+import pytest
+import core_func
+from cache import hash_key
+from jobs import JobJournal
+
+
+class FailingClient:
+    # Any request to it fails the test
+    @property
+    def chat(self):
+        raise AssertionError("No request expected")
+
+
+class CountingClient:
+    # Replies with the number of the request
+    def __init__(self):
+        self.requests = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages):
+        self.requests += 1
+        message = SimpleNamespace(content=f"Reply {self.requests}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_chat_completion_cache_is_keyed_by_model_and_prompt_version(monkeypatch):
+    client = CountingClient()
+    messages = [{"role": "user", "content": "Cache test:  take notes."}]
+    reply = core_func.create_chat_completion(client, "gpt-4o-mini", messages)
+    # Replayed, whitespace aside, without a request
+    same = [{"role": "user", "content": "Cache test: take notes."}]
+    assert core_func.create_chat_completion(client, "gpt-4o-mini", same) == reply
+    assert client.requests == 1
+
+    assert core_func.create_chat_completion(client, "gpt-4o", messages) != reply
+    assert client.requests == 2
+    monkeypatch.setattr(
+        core_func, "prompt_template_version", core_func.prompt_template_version + 1
+    )
+    assert core_func.create_chat_completion(client, "gpt-4o-mini", messages) != reply
+    assert client.requests == 3
+
+
+def test_parallel_notes_resume_with_every_chunk_journaled(byte_encoding):
+    chunks = ["First part.", "Second part.", "Third part."]
+    journal = JobJournal()
+    for index, chunk in enumerate(chunks):
+        journal.add_chunk_notes(hash_key(chunk), f"- Topic {index}")
+
+    replies = core_func.take_chunk_notes_parallel(
+        FailingClient(), "gpt-4o-mini", chunks, "English", journal=journal
+    )
+    assert replies == ["- Topic 0", "- Topic 1", "- Topic 2"]
+
+
+def test_tree_reduce_merges_long_sections_into_one_document(
+    byte_encoding, monkeypatch
+):
+    requested = []
+
+    def create_chat_completion(client, model, messages):
+        requested.append(messages[-1]["content"])
+        return messages[-1]["content"]
+
+    monkeypatch.setattr(core_func, "create_chat_completion", create_chat_completion)
+    notes_list = [f"- Topic {index}\n" + "* detail\n" * 100 for index in range(5)]
+    # No two neighbouring sections fit in token_limit together
+    notes = core_func.reduce_notes_tree(
+        None, "gpt-4o-mini", notes_list, "English", token_limit=1500
+    )
+    assert all(f"- Topic {index}" in requested[-1] for index in range(5))
+    assert notes == requested[-1]
+
+
+def test_serial_notes_carry_an_outline_of_the_earlier_replies(
+    byte_encoding, monkeypatch
+):
+    first_reply = "".join(
+        f"- Topic {index}\n* A detail of topic {index} that is long enough.\n"
+        for index in range(10)
+    )
+    requests = []
+
+    def create_chat_completion(client, model, messages):
+        requests.append(messages)
+        return first_reply if len(requests) == 1 else "- Last topic"
+
+    monkeypatch.setattr(core_func, "create_chat_completion", create_chat_completion)
+    chunks = ["The first part of the talk.", "The second part of the talk."]
+    core_func.take_chunk_notes_serial(None, "gpt-4o-mini", chunks, "English")
+
+    first, second = requests
+    # Same system prompt for every request, so it can be cached as a prefix
+    assert second[0] == first[0]
+    assert second[-1]["content"] == chunks[1]
+    context = second[1]["content"]
+    assert chunks[0] not in context
+    outline, tail = context.split("The previous notes ended with:\n")
+    assert "- Topic 0\n" in outline
+    assert "* A detail" not in outline
+    assert tail == core_func.get_tail_by_token_limit(first_reply.strip(), 200)
+
+
+def test_transcription_is_kept_when_the_notes_fail(
+    byte_encoding, monkeypatch, tmp_path
+):
+    audio_file = tmp_path / "talk.wav"
+    audio_file.write_bytes(b"audio")
+    segments = [" Hello there.", " This is the talk."]
+    monkeypatch.setattr(
+        core_func, "fasterWhisperSegments", lambda *args, **kwargs: iter(segments)
+    )
+    monkeypatch.setattr(core_func, "get_openai_client", lambda api_token: None)
+
+    def create_chat_completion(client, model, messages):
+        raise RuntimeError("API down")
+
+    monkeypatch.setattr(core_func, "create_chat_completion", create_chat_completion)
+    journal = JobJournal()
+    cache_key = core_func.get_audio_transcript_key(str(audio_file), "English", "medium")
+
+    with pytest.raises(RuntimeError):
+        core_func.take_notes_from_audio(
+            str(audio_file), "English", "key", file_remove=False, journal=journal
+        )
+    assert journal.get("transcription") == "".join(segments)
+    assert core_func.transcript_cache.get(cache_key) == "".join(segments)
+
+
+def test_whisper_failure_leaves_no_notes_of_part_of_the_audio(
+    byte_encoding, monkeypatch, tmp_path
+):
+    audio_file = tmp_path / "lecture.wav"
+    audio_file.write_bytes(b"lecture audio")
+    segments = [
+        "".join(f" Part {index}, sentence {i} of the lecture." for i in range(5))
+        for index in range(40)
+    ]
+
+    def failing_segments(*args, **kwargs):
+        for index, segment in enumerate(segments):
+            if index == 25:
+                raise RuntimeError("CUDA out of memory")
+            yield segment
+
+    monkeypatch.setattr(core_func, "fasterWhisperSegments", failing_segments)
+    monkeypatch.setattr(core_func, "get_openai_client", lambda api_token: None)
+    monkeypatch.setattr(
+        core_func,
+        "create_chat_completion",
+        lambda client, model, messages: "- " + messages[-1]["content"],
+    )
+    journal = JobJournal()
+    cache_key = core_func.get_audio_transcript_key(str(audio_file), "English", "medium")
+
+    with pytest.raises(RuntimeError, match="CUDA"):
+        core_func.take_notes_from_audio(
+            str(audio_file), "English", "key", file_remove=False, journal=journal
+        )
+    assert journal.get("notes") is None
+    assert journal.get("transcription") is None
+    assert core_func.transcript_cache.get(cache_key) is None
+
+    monkeypatch.setattr(
+        core_func, "fasterWhisperSegments", lambda *args, **kwargs: iter(segments)
+    )
+    transcription, notes = core_func.take_notes_from_audio(
+        str(audio_file), "English", "key", file_remove=False, journal=journal
+    )
+    assert transcription == "".join(segments)
+    assert "Part 39, sentence 4" in notes
+
+
+def test_resumed_audio_job_reuses_the_chunk_notes(
+    byte_encoding, monkeypatch, tmp_path
+):
+    audio_file = tmp_path / "talk.wav"
+    audio_file.write_bytes(b"longer audio")
+    segments = [
+        "".join(f" Um, part {index}, sentence {i} of the talk." for i in range(15))
+        for index in range(4)
+    ]
+    monkeypatch.setattr(
+        core_func, "fasterWhisperSegments", lambda *args, **kwargs: iter(segments)
+    )
+    monkeypatch.setattr(core_func, "get_openai_client", lambda api_token: None)
+    requested = []
+
+    def create_chat_completion(client, model, messages):
+        requested.append(messages[-1]["content"])
+        if len(requested) == 2:
+            raise RuntimeError("API down")
+        return f"- Topic {len(requested)}"
+
+    monkeypatch.setattr(core_func, "create_chat_completion", create_chat_completion)
+    journal = JobJournal()
+    with pytest.raises(RuntimeError):
+        core_func.take_notes_from_audio(
+            str(audio_file), "English", "key", file_remove=False, journal=journal
+        )
+    first_chunk = requested[0]
+
+    requested.clear()
+    core_func.take_notes_from_audio(
+        str(audio_file), "English", "key", file_remove=False, journal=journal
+    )
+    assert first_chunk not in requested
+
+
+@pytest.mark.parametrize("complete", [True, False])
+def test_notes_stream_sends_unfinished_lines_only_when_complete(
+    recording_notion, complete
+):
+    stream = core_func.NotionNotesStream("Title", "https://a.b", "token", "db")
+    stream.feed("- Topic\n* first point\n* second point\n** a half li")
+    stream.close(complete=complete)
+    texts = [
+        block[block["type"]]["rich_text"][0]["text"]["content"]
+        for block in recording_notion.blocks
+    ]
+    if complete:
+        assert texts == ["Topic", "first point", "second point"]
+        assert len(recording_notion.blocks[-1]["bulleted_list_item"]["children"]) == 1
+    else:
+        assert texts == ["Topic", "first point"]
+
+
+def test_notes_stream_resumes_after_a_failed_reply(
+    byte_encoding, monkeypatch, recording_notion
+):
+    replies = {
+        "First part.": "- Topic 1\n* point 1a\n* point 1b",
+        "Second part.": None,
+    }
+
+    def create_chat_completion(client, model, messages):
+        reply = replies[messages[-1]["content"]]
+        if reply is None:
+            raise RuntimeError("Connection reset")
+        return reply
+
+    monkeypatch.setattr(core_func, "create_chat_completion", create_chat_completion)
+    journal = JobJournal()
+    chunks = ["First part.", "Second part."]
+
+    stream = core_func.NotionNotesStream(
+        "Title", "https://a.b", "token", "db", journal=journal
+    )
+    with pytest.raises(RuntimeError):
+        core_func.take_chunk_notes_serial(
+            None,
+            "gpt-4o-mini",
+            chunks,
+            "English",
+            journal=journal,
+            on_notes=stream.feed,
+        )
+    stream.close(complete=False)
+
+    replies["Second part."] = "- Topic 2\n* point 2a"
+    stream = core_func.NotionNotesStream(
+        "Title", "https://a.b", "token", "db", journal=journal
+    )
+    core_func.take_chunk_notes_serial(
+        None, "gpt-4o-mini", chunks, "English", journal=journal, on_notes=stream.feed
+    )
+    stream.close()
+    texts = [
+        block[block["type"]]["rich_text"][0]["text"]["content"]
+        for block in recording_notion.blocks
+    ]
+    assert texts == ["Topic 1", "point 1a", "point 1b", "Topic 2", "point 2a"]
@@ -0,0 +1,212 @@
+import email.utils
+import logging
+import time
+from notion import (
+    MAX_RICH_TEXT_LENGTH,
+    NOTION_API_URL,
+    NotionClient,
+    batch_blocks,
+    get_notion_client,
+    get_retry_delay,
+    schema_cache,
+    split_rich_text,
+)
+from utils import text_block
+import core_func
+from jobs import JobJournal
+
+
+def bullet(content, children=0):
+    block = text_block("bulleted_list_item", content)
+    if children:
+        block["bulleted_list_item"]["children"] = [
+            text_block("bulleted_list_item", f"{content}.{index}")
+            for index in range(children)
+        ]
+    return block
+
+
+def test_split_rich_text_keeps_every_character():
+    content = "a" * (2 * MAX_RICH_TEXT_LENGTH + 5)
+    split = split_rich_text([{"type": "text", "text": {"content": content}}])
+    assert [len(item["text"]["content"]) for item in split] == [
+        MAX_RICH_TEXT_LENGTH,
+        MAX_RICH_TEXT_LENGTH,
+        5,
+    ]
+    assert "".join(item["text"]["content"] for item in split) == content
+
+
+def test_batches_hold_at_most_100_blocks():
+    batches = list(batch_blocks([bullet(str(index)) for index in range(250)]))
+    assert [len(batch) for batch, _ in batches] == [100, 100, 50]
+
+
+def test_batches_hold_at_most_1000_elements():
+    # Each block is itself plus its 99 children
+    batches = list(batch_blocks([bullet(str(index), 99) for index in range(25)]))
+    assert [len(batch) for batch, _ in batches] == [10, 10, 5]
+
+
+def test_children_beyond_100_are_deferred():
+    ((batch, deferred),) = batch_blocks([bullet("parent", 150)])
+    assert len(batch[0]["bulleted_list_item"]["children"]) == 100
+    assert len(deferred[0]) == 50
+    first = deferred[0][0]["bulleted_list_item"]["rich_text"][0]["text"]
+    assert first["content"] == "parent.100"
+
+
+class Response:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data or {}
+        self.text = str(self.data)
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+
+class FakeNotion(NotionClient):
+    # Fails the requests to the blocks in fail_blocks
+    def __init__(self, fail_blocks=()):
+        super().__init__("token")
+        self.fail_blocks = fail_blocks
+        self.next_id = 0
+        self.paths = []
+
+    def ids(self, count):
+        start, self.next_id = self.next_id, self.next_id + count
+        return [{"id": f"b{index}"} for index in range(start, self.next_id)]
+
+    def request(self, method, path, payload=None, idempotent=True):
+        self.paths.append(path)
+        if any(f"blocks/{block_id}/" in path for block_id in self.fail_blocks):
+            return Response(500)
+        if method == "POST":
+            return Response(200, {"id": "page"})
+        if method == "GET":
+            return Response(200, {"properties": {"Link": {"type": "url"}}})
+        return Response(200, {"results": self.ids(len(payload["children"]))})
+
+
+def test_failed_overflow_append_is_left_for_the_resume():
+    progress = []
+    notion = FakeNotion(fail_blocks=["b1"])
+    blocks = [bullet("one"), bullet("two", 150), bullet("three")]
+
+    def on_progress(appended, overflow):
+        progress.append((appended, overflow))
+
+    # The batch is on the page, only the children beyond 100 are missing
+    assert notion.append_blocks("page", blocks, on_progress=on_progress) == 3
+    ((appended, overflow),) = progress
+    assert appended == 3
+    assert [(parent_id, len(children)) for parent_id, children in overflow] == [
+        ("b1", 50)
+    ]
+
+    notion = FakeNotion()
+    assert notion.append_overflow(overflow) == []
+    assert notion.paths == ["blocks/b1/children"]
+
+
+def test_failed_overflow_on_a_new_page_is_resumed(monkeypatch):
+    blocks = [bullet("one", 150), bullet("two")]
+    notion = FakeNotion(fail_blocks=["b0"])
+    monkeypatch.setattr(
+        core_func, "get_notion_client", lambda token, logger=None: notion
+    )
+    monkeypatch.setattr(core_func, "parse_input", lambda notes: blocks)
+    journal = JobJournal()
+
+    page_id = core_func.create_notes_notion(
+        "notes", "Title", "https://a.b", "token", "db", journal=journal
+    )
+    assert page_id is None
+    notion_page = journal.get("notion_page")
+    assert notion_page["appended"] == 2
+    assert [parent_id for parent_id, _ in notion_page["overflow"]] == ["b0"]
+
+    notion.fail_blocks = []
+    notion.paths.clear()
+    page_id = core_func.create_notes_notion(
+        "notes", "Title", "https://a.b", "token", "db", journal=journal
+    )
+    assert page_id == "page"
+    # Only the missing children, no block appended to the page again
+    assert notion.paths == ["blocks/b0/children"]
+
+
+def test_retry_after_in_seconds_or_as_a_date():
+    assert get_retry_delay(Response(429, headers={"Retry-After": "3"}), 0) == 3
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    delay = get_retry_delay(Response(429, headers={"Retry-After": date}), 0)
+    assert 25 < delay <= 30
+    assert get_retry_delay(Response(429, headers={"Retry-After": "soon"}), 2) == 4
+    assert get_retry_delay(Response(503), 1) == 2
+
+
+class FakeSession:
+    # Replies with the given responses in turn
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, json=None, timeout=None):
+        self.requests.append((method, url))
+        return self.responses.pop(0)
+
+
+def test_server_errors_are_only_retried_for_idempotent_requests(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    client = NotionClient("token")
+    client.connection.session = FakeSession([Response(502), Response(200)])
+    assert client.request("POST", "pages", {}, idempotent=False).status_code == 502
+    assert client.request("GET", "databases/db").status_code == 200
+
+    client.connection.session = FakeSession([Response(429), Response(200)])
+    assert client.request("POST", "pages", {}, idempotent=False).status_code == 200
+
+
+def test_clients_share_the_session_but_not_the_logger():
+    first = get_notion_client("token", logger=logging.getLogger("first"))
+    second = get_notion_client("token", logger=logging.getLogger("second"))
+    assert first.connection is second.connection
+    assert second.logger.name == "second"
+
+
+def test_stale_schema_is_refreshed_when_the_page_is_rejected(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    with_link = {"Name": {"type": "title"}, "Link": {"type": "url"}}
+    client = NotionClient("token")
+    client.connection.session = FakeSession(
+        [
+            Response(200, {"properties": with_link}),
+            Response(400, {"code": "validation_error"}),
+            # The Link property was deleted since the schema was cached
+            Response(200, {"properties": {"Name": {"type": "title"}}}),
+            Response(200, {"properties": with_link}),
+            Response(200, {"id": "page"}),
+        ]
+    )
+    page_id = client.create_page(
+        "schema-db", {}, [], required_properties={"Link": "url"}
+    )
+    assert page_id == "page"
+    assert [method for method, _ in client.connection.session.requests] == [
+        "GET",
+        "POST",
+        "GET",
+        "PATCH",
+        "POST",
+    ]
+    assert schema_cache.get("schema-db") == {"Name": "title", "Link": "url"}
+
+    # The schema is then known, so the next page needs no schema request
+    client.connection.session = FakeSession([Response(200, {"id": "page 2"})])
+    page_id = client.create_page(
+        "schema-db", {}, [], required_properties={"Link": "url"}
+    )
+    assert page_id == "page 2"
+    assert client.connection.session.requests == [("POST", NOTION_API_URL + "pages")]
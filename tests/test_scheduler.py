@@ -0,0 +1,21 @@
+import scheduler
+from scheduler import StageScheduler
+
+
+def test_pipeline_streams_the_notes_to_notion(monkeypatch, recording_notion):
+    def take_notes_chatgpt(transcription, *args, on_notes=None, **kwargs):
+        notes = "- Topic\n* A point\n"
+        on_notes(notes)
+        return notes
+
+    monkeypatch.setattr(scheduler, "take_notes_chatgpt", take_notes_chatgpt)
+    pipeline = StageScheduler({"stream_notes": True})
+    state = pipeline._new_state({"input": "talk.txt"})
+    state["title"], state["transcription"] = "talk", "A talk."
+    pipeline.take_notes(state)
+    assert len(recording_notion.blocks) == 2
+    assert state["journal"].get("notion_page") == {
+        "id": "page",
+        "appended": 2,
+        "overflow": [],
+    }
@@ -0,0 +1,33 @@
+import threading
+import pytest
+import requests
+from client import JobClient
+from server import JobService, create_server
+
+
+def test_create_server_needs_a_token_off_loopback():
+    with pytest.raises(ValueError):
+        create_server({}, host="0.0.0.0", port=0)
+    server = create_server({}, host="0.0.0.0", port=0, token="secret")
+    server.server_close()
+
+
+def test_remote_clients_can_only_submit_urls():
+    service = JobService({}, workers=0)
+    with pytest.raises(ValueError):
+        service.submit({"input": "/etc/passwd"}, allow_files=False)
+    assert service.submit({"input": "https://example.com/talk"}, allow_files=False)
+    assert service.submit({"input": "talk.mp3"})
+
+
+def test_requests_need_the_token():
+    server = create_server({}, port=0, workers=0, token="secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with pytest.raises(requests.HTTPError):
+            JobClient(url, token="wrong").list()
+        assert JobClient(url, token="secret").list() == []
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,145 @@
+import pytest
+from utils import (
+    clean_subtitle_text,
+    download_subtitle,
+    find_caption_track,
+    read_ass_cues,
+    read_srt_vtt_cues,
+    subtitle_to_text,
+)
+
+srt = """1
+00:00:01,000 --> 00:00:02,500
+Hello there.
+
+2
+00:00:02,500 --> 00:00:03,000
+The answer is
+
+3
+00:00:03,000 --> 00:00:04,000
+42
+"""
+
+vtt = """WEBVTT
+
+00:00.000 --> 00:02.000
+<c>Rolling</c> captions
+
+00:02.000 --> 00:04.000
+Rolling captions
+grow here.
+"""
+
+dialogue = """1
+00:00:01,000 --> 00:00:02,000
+Did you finish?
+
+2
+00:00:02,000 --> 00:00:03,000
+Yes.
+
+3
+00:00:03,000 --> 00:00:04,000
+All of it?
+
+4
+00:00:04,000 --> 00:00:05,000
+Yes.
+
+5
+00:00:05,000 --> 00:00:06,000
+All of it?
+"""
+
+ass = """[Script Info]
+Title: Test
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+Dialogue: 0,0:00:01.00,0:00:02.50,Default,,0,0,0,,{\\an8}First line\\Nsecond, part.
+"""
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_srt_keeps_numeric_last_caption(tmp_path):
+    cues = list(read_srt_vtt_cues(write(tmp_path, "a.srt", srt)))
+    assert cues == [
+        (1.0, 2.5, "Hello there."),
+        (2.5, 3.0, "The answer is"),
+        (3.0, 4.0, "42"),
+    ]
+
+
+def test_vtt_collapses_rolling_captions(tmp_path, byte_encoding):
+    text, timestamps = subtitle_to_text(write(tmp_path, "a.vtt", vtt))
+    assert text == "Rolling captions grow here."
+    assert timestamps == [[0.0, 0]]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("<c.colorE5E5E5>so</c><00:00:01.240><c> this</c>", "so this"),
+        ("<i>Hello</i> <b>there</b>", "Hello there"),
+        ("<v Roger>Hi<01:02.500> all", "Hi all"),
+        ("if a < b > c", "if a < b > c"),
+        ("x <3 y", "x <3 y"),
+        ("{\\an8}Top line", "Top line"),
+    ],
+)
+def test_clean_subtitle_text_only_removes_tags(text, expected):
+    assert clean_subtitle_text(text) == expected
+
+
+def test_repeated_dialogue_is_kept(tmp_path, byte_encoding):
+    text, _ = subtitle_to_text(write(tmp_path, "a.srt", dialogue))
+    assert text == "Did you finish? Yes. All of it? Yes. All of it?"
+
+
+def test_ass_dialogue_lines(tmp_path, byte_encoding):
+    path = write(tmp_path, "a.ass", ass)
+    assert list(read_ass_cues(path)) == [
+        (1.0, 2.5, "{\\an8}First line\nsecond, part.")
+    ]
+    text, _ = subtitle_to_text(path)
+    assert text == "First line second, part."
+
+
+def test_download_subtitle_writes_inline_tracks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    info = {"title": "Talk", "subtitles": {"en": [{"ext": "srt", "data": srt}]}}
+    subtitle_file, fmt = download_subtitle("https://a.b", info=info)
+    assert fmt == "srt"
+    assert (tmp_path / subtitle_file).read_text(encoding="utf-8") == srt
+
+
+manual_en = {"en": [{"ext": "vtt", "url": "https://a.b/manual"}]}
+auto_en = {"en": [{"ext": "vtt", "url": "https://a.b/auto"}]}
+auto_en_orig = {"en-orig": [{"ext": "vtt", "url": "https://a.b/auto"}]}
+translated_en = {"en": [{"ext": "vtt", "url": "https://a.b/auto?tlang=en"}]}
+
+
+@pytest.mark.parametrize(
+    "subtitles, automatic_captions, expected",
+    [
+        (manual_en, auto_en, ("manual", "en")),
+        ({}, auto_en, ("auto", "en")),
+        ({}, auto_en_orig, ("auto", "en-orig")),
+        ({}, {**translated_en, **auto_en_orig}, ("auto", "en-orig")),
+        ({}, translated_en, ("translated", "en")),
+        ({"fr": manual_en["en"]}, translated_en, ("translated", "en")),
+        ({"fr": manual_en["en"]}, {}, (None, None)),
+        (None, None, (None, None)),
+    ],
+)
+def test_find_caption_track_ranks_manual_auto_translated(
+    subtitles, automatic_captions, expected
+):
+    info = {"subtitles": subtitles, "automatic_captions": automatic_captions}
+    assert find_caption_track(info, "English") == expected
@@ -0,0 +1,200 @@
+import wave
+import contextlib
+import threading
+import numpy as np
+from faster_whisper import decode_audio
+import utils
+from utils import (
+    compress_line,
+    compress_text_stream,
+    is_in_language,
+    stream_audio_chunks,
+    WhisperModelCache,
+)
+
+
+def test_is_in_language_tells_latin_languages_apart():
+    english = "The results of the study show that the model is faster than before."
+    spanish = "Los resultados del estudio muestran que el modelo es más rápido."
+    assert is_in_language(english, "English")
+    assert not is_in_language(english, "Español")
+    assert is_in_language(spanish, "Español")
+    assert not is_in_language(spanish, "English")
+
+
+def test_is_in_language_tells_chinese_scripts_and_japanese_apart():
+    simplified = "这个问题的数据说明，我们的实现还可以更快。"
+    traditional = "這個問題的數據說明，我們的實現還可以更快。"
+    japanese = "この問題のデータは、実装がもっと速くなることを示しています。"
+    assert is_in_language(simplified, "简体中文")
+    assert not is_in_language(simplified, "繁體中文")
+    assert is_in_language(traditional, "繁體中文")
+    assert not is_in_language(traditional, "简体中文")
+    assert is_in_language(japanese, "日本語")
+    assert not is_in_language(japanese, "简体中文")
+    assert not is_in_language(simplified, "日本語")
+
+
+def write_tone(audio_file, seconds, sampling_rate=16000):
+    tone = np.sin(np.arange(seconds * sampling_rate) * 2 * np.pi * 440 / sampling_rate)
+    with wave.open(str(audio_file), "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sampling_rate)
+        file.writeframes((tone * 10000).astype(np.int16).tobytes())
+
+
+def test_read_audio_head_matches_the_decoded_audio(tmp_path):
+    audio_file = tmp_path / "tone.wav"
+    write_tone(audio_file, 45)
+    audio = decode_audio(str(audio_file))
+    head = utils.read_audio_head(str(audio_file), 30)
+    assert np.array_equal(head, audio[: 30 * 16000])
+
+
+def test_stream_audio_chunks_matches_the_decoded_audio(tmp_path):
+    sampling_rate = 16000
+    audio_file = tmp_path / "tone.wav"
+    write_tone(audio_file, 25)
+
+    audio = decode_audio(str(audio_file), sampling_rate=sampling_rate)
+    chunks = list(stream_audio_chunks(str(audio_file), max_chunk_seconds=10))
+    assert all(len(samples) <= 10 * sampling_rate for samples, _ in chunks)
+    # Chunks cut without a pause overlap the one before by a second
+    rebuilt = np.concatenate(
+        [
+            samples[sampling_rate:] if overlapped else samples
+            for samples, overlapped in chunks
+        ]
+    )
+    assert np.array_equal(rebuilt, audio)
+
+
+class FakePool:
+    def __init__(self):
+        self.shut_down = False
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def test_whisper_model_cache_keeps_models_in_use():
+    cache = WhisperModelCache(max_models=1)
+    with cache.use("tiny", "cpu x2", loader=FakePool, memory=1) as pool:
+        other = cache.get("base", "cpu x2", loader=FakePool, memory=1)
+        assert not pool.shut_down
+    cache.get("small", "cpu x2", loader=FakePool, memory=1)
+    assert pool.shut_down and other.shut_down
+
+
+def test_whisper_model_cache_loads_outside_the_lock():
+    cache = WhisperModelCache(max_models=2)
+    warm = cache.get("tiny", "cpu x2", loader=FakePool, memory=1)
+    started, finish = threading.Event(), threading.Event()
+    loads = []
+
+    def slow_loader():
+        loads.append(1)
+        started.set()
+        finish.wait(5)
+        return FakePool()
+
+    def load():
+        cache.get("base", "cpu x2", loader=slow_loader, memory=1)
+
+    threads = [threading.Thread(target=load) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    # The warm model is returned while the other one is still loading
+    reused = []
+    reuse = threading.Thread(
+        target=lambda: reused.append(cache.get("tiny", "cpu x2", memory=1))
+    )
+    reuse.start()
+    reuse.join(1)
+    finish.set()
+    assert reused == [warm]
+    for thread in threads:
+        thread.join(5)
+    assert loads == [1]
+
+
+def test_get_batch_size_follows_free_device_memory(monkeypatch):
+    monkeypatch.setattr(utils, "get_free_memory", lambda device: 1024**3)
+    assert utils.get_batch_size("medium", "float16", device="cuda") == 6
+    monkeypatch.setattr(utils, "get_free_memory", lambda device: None)
+    # Without a measurement, the model cache's budget is the limit
+    assert utils.get_batch_size("medium", "float16", device="cuda") == 32
+
+
+def test_compress_line_collapses_loops_and_fillers():
+    assert compress_line("the the the cat", "en") == "the cat"
+    assert compress_line("So , um , it works .", "en") == "So, it works."
+    assert compress_line("我觉得我觉得我觉得好", "zh") == "我觉得好"
+    assert compress_line("好好好好好好好好", "zh") == "好好"
+
+
+def test_compress_line_keeps_numbers():
+    assert compress_line("价格是一百一百一百元", "zh") == "价格是一百一百一百元"
+    assert compress_line("It was .5 of the total", "en") == "It was .5 of the total"
+
+
+def test_compress_line_keeps_units_and_latin_text():
+    assert compress_line("We used a 35 mm lens", "en") == "We used a 35 mm lens"
+    assert compress_line("Толщина 5 мм", "ru") == "Толщина 5 мм"
+    text = "访问www.example.com获取AAA级评级"
+    assert compress_line(text, "zh") == text
+    assert compress_line("谢谢谢谢大家", "zh") == "谢谢谢谢大家"
+
+
+def test_compress_line_keeps_code_punctuation():
+    assert compress_line("Use std::vector here", "en") == "Use std::vector here"
+    assert compress_line(".NET is a framework", "en") == ".NET is a framework"
+    assert compress_line("... and then it failed", "en") == "... and then it failed"
+    assert compress_line("Wait.... what", "en") == "Wait... what"
+    assert compress_line("I use .NET daily", "en") == "I use .NET daily"
+    assert compress_line("Files like .py and .txt", "en") == "Files like .py and .txt"
+    assert compress_line("Hello :) there", "en") == "Hello :) there"
+
+
+def test_compress_line_drops_the_punctuation_of_fillers():
+    assert compress_line("hmm?", "en") == ""
+    assert compress_line("So, um. It works", "en") == "So, It works"
+    assert compress_line("嗯。好的", "zh") == "好的"
+
+
+def test_compress_text_stream_keeps_repeated_short_segments(byte_encoding):
+    segments = ["Thank you.", "Thank you.", "Bye."]
+    assert list(compress_text_stream(segments, "en")) == segments
+    loop = ["Thank you."] * 4
+    assert list(compress_text_stream(loop, "en")) == ["Thank you."] * 2
+    long_loop = ["We will look at the next slide now."] * 3
+    assert list(compress_text_stream(long_loop, "en")) == long_loop[:1]
+
+
+def test_default_profile_decodes_sequentially(monkeypatch):
+    class Segment:
+        text, end = " Hello.", 1.0
+
+    class Info:
+        duration = 1.0
+
+    class FakeModel:
+        def transcribe(self, file_path, **kwargs):
+            return iter([Segment()]), Info()
+
+    class FakeModelCache:
+        @contextlib.contextmanager
+        def use(self, *args, **kwargs):
+            yield FakeModel()
+
+    def batched_segments(*args, **kwargs):
+        raise AssertionError("Batched decoding is not the default")
+
+    monkeypatch.setattr(
+        utils, "get_tuned_compute_type", lambda *args, **kwargs: ("cuda", "float16")
+    )
+    monkeypatch.setattr(utils, "fasterWhisperBatchedSegments", batched_segments)
+    monkeypatch.setattr(utils, "whisper_model_cache", FakeModelCache())
+    assert list(utils.fasterWhisperSegments("talk.wav", "en")) == [" Hello."]
@@ -1,13 +1,36 @@
 import os
 import yt_dlp
 import logging
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, decode_audio
+from faster_whisper.audio import (
+    pad_or_trim,
+    _ignore_invalid_frames,
+    _group_frames,
+    _resample_frames,
+)
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import get_ctranslate2_storage, get_suppressed_tokens
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+import numpy as np
+import av
+import ctranslate2
 import sys
 import tiktoken
-import requests
-import platform
 from openai import OpenAI
 import re
+import gc
+import copy
+import html
+import functools
+import contextlib
+import multiprocessing
+import hashlib
+import threading
+import time
+import subprocess
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cache import DiskCache, hash_key
 
 
 language_dict = {
@@ -124,6 +147,77 @@ language_dict = {
 }
 
 
+# Characters of the script each language is written in, used to check whether
+# notes already are in the target language
+latin_script = r"[A-Za-z\u00c0-\u024f]"
+language_script_dict = {
+    "简体中文": r"[\u4e00-\u9fff]",
+    "繁體中文": r"[\u4e00-\u9fff]",
+    "English": latin_script,
+    "Español": latin_script,
+    "Français": latin_script,
+    "Deutsch": latin_script,
+    "Português": latin_script,
+    "Русский": r"[\u0400-\u04ff]",
+    "日本語": r"[\u3040-\u30ff\u4e00-\u9fff]",
+    "العربية": r"[\u0600-\u06ff]",
+    "हिन्दी": r"[\u0900-\u097f]",
+    "한국어": r"[\uac00-\ud7af\u1100-\u11ff]",
+    "Italiano": latin_script,
+}
+
+
+# Languages sharing a script are told apart by their most common words...
+language_stopwords = {
+    "English": "the and of to is in that it with for are this was be on not",
+    "Español": "el la los las de que y en es por con para una del se no",
+    "Français": "le la les de des et est en que une du pour dans pas sur qui",
+    "Deutsch": "der die das und ist nicht mit den von zu ein eine auf für sich dem",
+    "Português": "o os as de que e do da em um uma para com não dos é",
+    "Italiano": "il lo la gli le di che e è un una per con non del della",
+}
+language_stopwords = {
+    language: set(words.split()) for language, words in language_stopwords.items()
+}
+
+# ...and Chinese by characters written differently in Simplified and
+# Traditional (same position in both strings)
+simplified_chars = "这们来时说个为会对学过还发后样经实现点问题动关开数据长东车门见话语读书买卖电华国间种应该"
+traditional_chars = "這們來時說個為會對學過還發後樣經實現點問題動關開數據長東車門見話語讀書買賣電華國間種應該"
+kana_script = r"[\u3040-\u30ff]"
+
+
+def is_in_language(text, language, threshold=0.5):
+    script = language_script_dict.get(language)
+    letters = sum(1 for char in text if char.isalpha())
+    if script is None or letters == 0:
+        return True
+    script_count = len(re.findall(script, text))
+    if script_count / letters < threshold:
+        return False
+
+    if language in language_stopwords:
+        words = re.findall(r"[^\W\d_]+", text.lower())
+        hits = {
+            other: sum(word in stopwords for word in words)
+            for other, stopwords in language_stopwords.items()
+        }
+        return hits[language] == max(hits.values())
+    # Japanese is written with kana between its kanji, Chinese never is
+    kana_share = len(re.findall(kana_script, text)) / script_count
+    if language == "日本語":
+        return kana_share >= 0.1
+    if language in ("简体中文", "繁體中文"):
+        if kana_share >= 0.1:
+            return False
+        simplified = sum(text.count(char) for char in simplified_chars)
+        traditional = sum(text.count(char) for char in traditional_chars)
+        if language == "简体中文":
+            return simplified >= traditional
+        return traditional >= simplified
+    return True
+
+
 def find_matching_item(a, b):
     set_b = set(b)
     for item in a:
@@ -132,147 +226,1100 @@ def find_matching_item(a, b):
     return None
 
 
-def get_video_info(url):
+# Caption sources tried in order: uploader subtitles, auto-generated captions in
+# the spoken language, then auto-captions machine-translated by the site
+default_caption_sources = ["manual", "auto", "translated"]
+
+# Per-language override of default_caption_sources, e.g. "日本語": ["manual", "auto"]
+caption_source_dict = {}
+
+
+def is_translated_caption(tracks):
+    return any("tlang=" in track.get("url", "") for track in tracks)
+
+
+def find_caption_track(info, language):
+    codes = language_dict[language]
+    subtitles = info.get("subtitles") or {}
+    automatic_captions = info.get("automatic_captions") or {}
+    original_captions = {
+        lang: tracks
+        for lang, tracks in automatic_captions.items()
+        if not is_translated_caption(tracks)
+    }
+
+    for source in caption_source_dict.get(language, default_caption_sources):
+        if source == "manual":
+            lang = find_matching_item(codes, subtitles)
+        elif source == "auto":
+            lang = find_matching_item(
+                codes + [f"{code}-orig" for code in codes], original_captions
+            )
+        elif source == "translated":
+            lang = find_matching_item(codes, automatic_captions)
+        else:
+            lang = None
+        if lang is not None:
+            return source, lang
+    return None, None
+
+
+video_info_cache = DiskCache("video_info", max_bytes=64 * 1024**2, ttl=3600)
+
+
+def sanitize_filename(title):
+    illegal_characters = ["\\", "/", ":", "*", "?", '"', "<", ">", "|"]
+    for char in illegal_characters:
+        title = title.replace(char, "")
+    return title
+
+
+def extract_video_info(url, logger=None, use_cache=True):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if use_cache:
+        info = video_info_cache.get(url)
+        if info is not None:
+            logger.info(f"Using cached video info for {url}")
+            return info
+
     ydl_opts = {
         "quiet": True,
         "skip_download": True,
     }
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        title = info.get("title")
-        subtitles = info.get("subtitles")
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+    video_info_cache.set(url, info)
+    return info
+
+
+def get_video_info(url, info=None):
+    if info is None:
+        info = extract_video_info(url)
+    title = info.get("title")
+    subtitles = info.get("subtitles")
 
     return title, subtitles
 
 
 def download_subtitle(
-    url, lang="en", preferred_formats=["srt", "vtt", "ass"], logger=None
+    url,
+    lang="en",
+    preferred_formats=["srt", "vtt", "ass"],
+    logger=None,
+    info=None,
+    source="manual",
 ):
     if logger is None:
         logger = logging.getLogger(__name__)
-    title, subtitles = get_video_info(url)
+    if info is None:
+        info = extract_video_info(url, logger=logger)
+    title, subtitles = get_video_info(url, info=info)
+    if source != "manual":
+        subtitles = info.get("automatic_captions")
 
     if not subtitles or lang not in subtitles:
         logger.info(f"No subtitles available in the requested language: {lang}")
         return None, None
 
-    illegal_characters = ["\\", "/", ":", "*", "?", '"', "<", ">", "|"]
-    for char in illegal_characters:
-        title = title.replace(char, "")
+    title = sanitize_filename(title)
 
     # Check for formats
     available_subs = subtitles[lang]
     for fmt in preferred_formats:
         for sub in available_subs:
             if sub["ext"] == fmt:
-                ydl_opts = {
-                    "quiet": True,
-                    "skip_download": True,
-                    "writesubtitles": True,
-                    "subtitlesformat": fmt,
-                    "subtitleslangs": [lang],
-                    "outtmpl": title,
-                }
-
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-                logger.info(f"Subtitle downloaded and saved as '{title}.{lang}.{fmt}'")
-                return f"{title}.{lang}.{fmt}", fmt
+                subtitle_file = f"{title}.{lang}.{fmt}"
+                if sub.get("data") is not None:
+                    # Some extractors give the track inline instead of a URL
+                    data = sub["data"].encode("utf-8")
+                else:
+                    # The track URL is already in the info dict, no need to
+                    # re-extract
+                    with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
+                        data = ydl.urlopen(sub["url"]).read()
+                with open(subtitle_file, "wb") as file:
+                    file.write(data)
+                logger.info(f"Subtitle downloaded and saved as '{subtitle_file}'")
+                return subtitle_file, fmt
     return None, None
 
 
-def convert_ass_to_text(ass_file):
-    transcription = []
-    with open(ass_file, "r", encoding="utf-8") as file:
+def parse_timestamp(value):
+    # "01:02:03,500" (SRT), "02:03.500" (VTT) or "1:02:03.50" (ASS) in seconds
+    seconds = 0.0
+    for part in value.strip().replace(",", ".").split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def read_srt_vtt_cues(srt_vtt_file):
+    # Yields (start, end, text) per cue, reading the file line by line
+    start = end = None
+    lines = []
+    index_line = None
+    with open(srt_vtt_file, "r", encoding="utf-8-sig") as file:
         for line in file:
-            if not line.startswith("Dialogue:"):
+            line = line.strip()
+            if "-->" in line:
+                if lines:
+                    yield start, end, "\n".join(lines)
+                begin, _, rest = line.partition("-->")
+                start, end = parse_timestamp(begin), parse_timestamp(rest.split()[0])
+                lines, index_line = [], None
                 continue
-            line = line.split(",", 9)[-1]
-            transcription.append(line.strip())
+            # A number before a timing line is an SRT cue index, not text
+            if index_line is not None:
+                lines.append(index_line)
+                index_line = None
+            if not line or start is None:
+                continue
+            if line.isdigit():
+                index_line = line
+            else:
+                lines.append(line)
+    if index_line is not None:
+        lines.append(index_line)
+    if lines:
+        yield start, end, "\n".join(lines)
 
-    return " ".join(transcription)
 
+ass_event_fields = ["Layer", "Start", "End", "Style", "Name"]
+ass_event_fields += ["MarginL", "MarginR", "MarginV", "Effect", "Text"]
 
-def convert_srt_vtt_to_text(srt_vtt_file):
-    transcription = []
-    with open(srt_vtt_file, "r", encoding="utf-8") as file:
+
+def read_ass_cues(ass_file):
+    # Yields (start, end, text) per Dialogue line of the [Events] section
+    fields = ass_event_fields
+    section = None
+    with open(ass_file, "r", encoding="utf-8-sig") as file:
         for line in file:
-            if (
-                line.strip()
-                and not line.startswith("WEBVTT")
-                and "Kind: captions" not in line
-                and "Language:" not in line
-            ):
-                if not line.strip().isdigit() and "-->" not in line:
-                    transcription.append(line.strip())
+            line = line.strip()
+            if line.startswith("["):
+                section = line.lower()
+            elif section == "[events]" and line.startswith("Format:"):
+                fields = [field.strip() for field in line[7:].split(",")]
+            elif line.startswith("Dialogue:"):
+                values = line[9:].split(",", len(fields) - 1)
+                event = dict(zip(fields, values))
+                text = re.sub(r"\\[Nn]", "\n", event.get("Text", ""))
+                start = parse_timestamp(event["Start"])
+                yield start, parse_timestamp(event["End"]), text
+
+
+# <c>, <i>, <00:00:01.000> (VTT/SRT) and {\an8}-style overrides (ASS). Only
+# tag names and timestamps, "a < b > c" is text.
+subtitle_tag = re.compile(
+    r"</?[A-Za-z][^<>]*>|<(?:\d+:)?\d{2}:\d{2}[.,]\d{3}>|\{[^}]*\}"
+)
+
+
+def clean_subtitle_text(text):
+    text = subtitle_tag.sub("", text).replace("\\h", " ")
+    return html.unescape(text)
+
+
+def collapse_rolling_cues(cues):
+    # Rolling captions repeat the lines of the previous cue at the top of the
+    # next one, which starts as it ends, and word-by-word captions grow the same
+    # line. Only new text is kept. Cues apart in time are never trimmed, since
+    # dialogue does repeat itself.
+    previous, previous_end = [], None
+    for start, end, text in cues:
+        lines = []
+        for line in clean_subtitle_text(text).split("\n"):
+            line = " ".join(line.split())
+            if line:
+                lines.append(line)
+        rolling = previous_end is not None and start <= previous_end
+        parts = []
+        for line in lines:
+            if rolling and line in previous:
+                continue
+            if rolling and previous and line.startswith(previous[-1] + " "):
+                parts.append(line[len(previous[-1]) + 1 :])
+                continue
+            parts.append(line)
+        previous, previous_end = lines, end
+        if parts:
+            yield start, end, " ".join(parts)
+
 
-    return " ".join(transcription)
+def merge_cues(cues, max_seconds=30):
+    # Joins cues into segments that end with a sentence or after max_seconds
+    segment = None
+    for start, end, text in cues:
+        if segment is None:
+            segment = [start, end, text]
+        else:
+            segment[1] = end
+            segment[2] += " " + text
+        if ends_with_sentence.search(text) or end - segment[0] >= max_seconds:
+            yield tuple(segment)
+            segment = None
+    if segment is not None:
+        yield tuple(segment)
 
 
-def download_audio(url, logger=None):
+def subtitle_to_text(subtitle_file, logger=None):
+    # Returns the normalized text of an SRT/VTT/ASS file and its timestamps as
+    # [start seconds, character offset in the text] per merged segment
     if logger is None:
         logger = logging.getLogger(__name__)
+    if subtitle_file.endswith(".ass"):
+        cues = read_ass_cues(subtitle_file)
+    else:
+        cues = read_srt_vtt_cues(subtitle_file)
 
-    title, subtitles = get_video_info(url)
-    illegal_characters = ["\\", "/", ":", "*", "?", '"', "<", ">", "|"]
-    for char in illegal_characters:
-        title = title.replace(char, "")
+    raw_tokens = 0
+
+    def counted(cues):
+        nonlocal raw_tokens
+        for cue in cues:
+            raw_tokens += count_tokens(cue[2])
+            yield cue
+
+    parts, timestamps = [], []
+    offset, duration = 0, 0.0
+    for start, end, text in merge_cues(collapse_rolling_cues(counted(cues))):
+        timestamps.append([round(start, 2), offset])
+        parts.append(text)
+        offset += len(text) + 1
+        duration = end
+    transcription = " ".join(parts)
+
+    tokens = count_tokens(transcription)
+    minutes = max(duration / 60, 1 / 60)
+    logger.info(
+        f"Subtitle tokens per minute: {raw_tokens / minutes:.0f} -> "
+        f"{tokens / minutes:.0f} ({1 - tokens / max(raw_tokens, 1):.0%} fewer)"
+    )
+    return transcription, timestamps
+
+
+def convert_ass_to_text(ass_file):
+    return subtitle_to_text(ass_file)[0]
+
+
+def convert_srt_vtt_to_text(srt_vtt_file):
+    return subtitle_to_text(srt_vtt_file)[0]
+
+
+def download_audio(url, logger=None, info=None, progress_hook=None):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if info is None:
+        info = extract_video_info(url, logger=logger)
+
+    title = sanitize_filename(info.get("title"))
     ydl_opts = {"format": "bestaudio", "outtmpl": f"{title}.%(ext)s", "quiet": True}
+    if progress_hook is not None:
+        # Exceptions raised by the hook abort the download
+        ydl_opts["progress_hooks"] = [progress_hook]
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-        info = ydl.extract_info(url, download=False)
-        ext = info.get("ext")
+        try:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        except yt_dlp.utils.DownloadError:
+            # Format URLs in a cached info dict may have expired
+            logger.warning("Download from cached info failed, extracting again....")
+            info = extract_video_info(url, logger=logger, use_cache=False)
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
 
-    logger.info(f"Audio downloaded and saved as '{title}.{ext}'")
-    return f"{title}.{ext}"
+    requested = result.get("requested_downloads") or [{}]
+    audio_file = requested[0].get("filepath") or f"{title}.{result.get('ext')}"
+    logger.info(f"Audio downloaded and saved as '{audio_file}'")
+    return audio_file
 
 
-def whisperAPITranscribe(audio_file, language, api_token, logger=None):
+_openai_clients = {}
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_token):
+    # One client (and connection pool) per token for the life of the process
+    with _openai_clients_lock:
+        if api_token not in _openai_clients:
+            _openai_clients[api_token] = OpenAI(api_key=api_token)
+        return _openai_clients[api_token]
+
+
+# Upload limit of the Whisper API
+WHISPER_API_MAX_BYTES = 25 * 1024**2
+
+
+def split_audio_at_silence(
+    audio, sampling_rate=16000, max_chunk_seconds=600, overlap_seconds=1.0
+):
+    # Returns (start, end, overlaps_previous) sample ranges of at most
+    # max_chunk_seconds, cut in the pauses found by the VAD. Only a chunk with
+    # no pause to cut at is cut hard, overlapping the next one.
+    speech = get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=500))
+    pauses = [
+        (before["end"] + after["start"]) // 2
+        for before, after in zip(speech, speech[1:])
+    ]
+    max_length = int(max_chunk_seconds * sampling_rate)
+    overlap = int(overlap_seconds * sampling_rate)
+
+    chunks = []
+    start, overlapped = 0, False
+    while len(audio) - start > max_length:
+        limit = start + max_length
+        # The last pause before the limit, unless it makes a short chunk
+        cuts = [pause for pause in pauses if start + max_length // 2 < pause <= limit]
+        if cuts:
+            chunks.append((start, cuts[-1], overlapped))
+            start, overlapped = cuts[-1], False
+        else:
+            chunks.append((start, limit, overlapped))
+            start, overlapped = limit - overlap, True
+    chunks.append((start, len(audio), overlapped))
+    return chunks
+
+
+def stream_audio(input_file, sampling_rate=16000):
+    # decode_audio in pieces of about 30 s, so a long recording is never
+    # whole in memory
+    resampler = av.audio.resampler.AudioResampler(
+        format="s16", layout="mono", rate=sampling_rate
+    )
+    with av.open(input_file, mode="r", metadata_errors="ignore") as container:
+        frames = _ignore_invalid_frames(container.decode(audio=0))
+        frames = _resample_frames(_group_frames(frames, 500000), resampler)
+        for frame in frames:
+            yield frame.to_ndarray().reshape(-1).astype(np.float32) / 32768.0
+
+
+def read_audio_head(input_file, seconds, sampling_rate=16000):
+    # The first seconds of decode_audio, without decoding the rest
+    length = int(seconds * sampling_rate)
+    pieces, read = [], 0
+    audio = stream_audio(input_file, sampling_rate)
+    for samples in audio:
+        pieces.append(samples)
+        read += len(samples)
+        if read >= length:
+            break
+    audio.close()
+    if not pieces:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(pieces)[:length]
+
+
+def stream_audio_chunks(
+    input_file, sampling_rate=16000, max_chunk_seconds=600, overlap_seconds=1.0
+):
+    # split_audio_at_silence while decoding: yields (samples, overlaps_previous)
+    # and never holds much more than two chunks of audio
+    max_length = int(max_chunk_seconds * sampling_rate)
+    buffer = np.zeros(0, dtype=np.float32)
+    overlapped = False
+    for samples in stream_audio(input_file, sampling_rate):
+        buffer = np.concatenate([buffer, samples])
+        while len(buffer) > max_length:
+            chunks = split_audio_at_silence(
+                buffer, sampling_rate, max_chunk_seconds, overlap_seconds
+            )
+            (start, end, _), (next_start, _, next_overlapped) = chunks[:2]
+            yield buffer[start:end], overlapped
+            buffer, overlapped = buffer[next_start:], next_overlapped
+    if len(buffer):
+        yield buffer, overlapped
+
+
+def encode_opus(samples, output_file, sampling_rate=16000, bitrate=24000):
+    # Mono Opus in Ogg is a tenth of the size of the usual bestaudio download
+    with av.open(output_file, "w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sampling_rate)
+        stream.codec_context.bit_rate = bitrate
+        stream.layout = "mono"
+        frame = av.AudioFrame.from_ndarray(
+            samples.reshape(1, -1), format="flt", layout="mono"
+        )
+        frame.sample_rate = sampling_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+
+def normalize_word(word):
+    return re.sub(r"[^\w]", "", word.lower())
+
+
+def merge_overlapping_texts(texts, max_overlap_words=30):
+    # texts are (text, overlaps_previous). Where two chunks overlap, the words
+    # the previous chunk ends with are dropped from the start of the next one.
+    words = []
+    for text, overlapped in texts:
+        chunk_words = text.split()
+        if overlapped and words:
+            tail = [normalize_word(word) for word in words[-max_overlap_words:]]
+            head = [normalize_word(word) for word in chunk_words[:max_overlap_words]]
+            for size in range(min(len(tail), len(head)), 0, -1):
+                if tail[-size:] == head[:size]:
+                    chunk_words = chunk_words[size:]
+                    break
+        words.extend(chunk_words)
+    return " ".join(words)
+
+
+def whisperAPITranscribe(
+    audio_file,
+    language,
+    api_token,
+    logger=None,
+    max_workers=4,
+    chunk_seconds=600,
+    bitrate=24000,
+):
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    # Opus is VBR, leave room for twice the nominal bitrate
+    max_chunk_seconds = min(chunk_seconds, WHISPER_API_MAX_BYTES * 8 / (2 * bitrate))
+    logger.info("Transcribing the audio with the Whisper API....")
+    client = get_openai_client(api_token)
+
+    def transcribe(chunk_file):
+        try:
+            with open(chunk_file, "rb") as chunk_audio:
+                return client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=chunk_audio,
+                    language=language,
+                    response_format="text",
+                )
+        finally:
+            os.remove(chunk_file)
+
+    futures, overlaps, seconds = [], [], 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Chunks are encoded as they are decoded, so only the small Opus files
+        # wait for the upload workers
+        for index, (samples, overlapped) in enumerate(
+            stream_audio_chunks(audio_file, max_chunk_seconds=max_chunk_seconds)
+        ):
+            chunk_file = f"{audio_file}.{index}.ogg"
+            encode_opus(samples, chunk_file, bitrate=bitrate)
+            seconds += len(samples) / 16000
+            futures.append(executor.submit(transcribe, chunk_file))
+            overlaps.append(overlapped)
+        texts = [
+            (future.result(), overlapped)
+            for future, overlapped in zip(futures, overlaps)
+        ]
+    logger.info(f"Transcribed {seconds:.0f}s of audio in {len(texts)} chunks")
+    return merge_overlapping_texts(texts)
+
+
+# Rough resident size (bytes) of each Whisper model in float16/float32
+WHISPER_MODEL_MEMORY = {
+    "tiny": 150 * 1024**2,
+    "base": 300 * 1024**2,
+    "small": 1024**3,
+    "medium": 3 * 1024**3,
+    "large-v1": 6 * 1024**3,
+    "large-v2": 6 * 1024**3,
+    "large-v3": 6 * 1024**3,
+}
+
+
+def estimate_model_memory(model_size, compute_type="default"):
+    base_size = model_size.split(".")[0]
+    memory = WHISPER_MODEL_MEMORY.get(base_size, 3 * 1024**3)
+    if compute_type.startswith("int8"):
+        memory //= 2
+    elif compute_type == "float32":
+        memory *= 2
+    return memory
+
+
+class WhisperModelCache:
+    def __init__(self, max_models=2, idle_timeout=600, max_memory=8 * 1024**3):
+        self.max_models = max_models
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        # key -> [model, last_used, memory, users]; entries in use are never
+        # evicted, a pool shut down under a job would fail it
+        self._models = OrderedDict()
+        # key -> (event set once loaded, memory) of the models being loaded,
+        # which happens outside the lock so warm models stay available
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        model_size,
+        device="auto",
+        compute_type="default",
+        logger=None,
+        loader=None,
+        memory=None,
+        checkout=False,
+    ):
+        # loader() builds something other than a plain WhisperModel for the key,
+        # e.g. a pool of model processes; it is shut down when evicted.
+        # checkout=True keeps the entry until release(), see use().
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        key = (model_size, device, compute_type)
+        if memory is None:
+            memory = estimate_model_memory(model_size, compute_type)
+        while True:
+            with self._lock:
+                self._evict_idle(logger)
+                entry = self._models.get(key)
+                if entry is not None:
+                    entry[1] = time.monotonic()
+                    entry[3] += checkout
+                    self._models.move_to_end(key)
+                    logger.info(f"Reusing loaded Whisper model {key}")
+                    return entry[0]
+                if key not in self._loading:
+                    self._evict_for(memory, logger)
+                    loaded = threading.Event()
+                    self._loading[key] = (loaded, memory)
+                    break
+                loaded = self._loading[key][0]
+            # Another thread is loading it, reuse it once loaded (or load it
+            # here if that failed)
+            loaded.wait()
+
+        try:
+            logger.info(f"Loading Whisper model {key}")
+            if loader is None:
+                model = WhisperModel(
+                    model_size, device=device, compute_type=compute_type
+                )
+            else:
+                model = loader()
+            with self._lock:
+                self._models[key] = [model, time.monotonic(), memory, int(checkout)]
+            return model
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loaded.set()
+
+    def release(self, model_size, device="auto", compute_type="default"):
+        with self._lock:
+            entry = self._models.get((model_size, device, compute_type))
+            if entry is not None:
+                entry[1] = time.monotonic()
+                entry[3] = max(entry[3] - 1, 0)
+
+    @contextlib.contextmanager
+    def use(self, model_size, device="auto", compute_type="default", **kwargs):
+        model = self.get(model_size, device, compute_type, checkout=True, **kwargs)
+        try:
+            yield model
+        finally:
+            self.release(model_size, device, compute_type)
+
+    def evict_idle(self, logger=None):
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        with self._lock:
+            self._evict_idle(logger)
+
+    def clear(self):
+        with self._lock:
+            for entry in self._models.values():
+                self._unload(entry)
+            self._models.clear()
+        gc.collect()
+
+    def _unload(self, entry):
+        if hasattr(entry[0], "shutdown"):
+            entry[0].shutdown(wait=False, cancel_futures=True)
+
+    def _evict_idle(self, logger):
+        now = time.monotonic()
+        idle = [
+            k
+            for k, v in self._models.items()
+            if v[3] == 0 and now - v[1] > self.idle_timeout
+        ]
+        for key in idle:
+            logger.info(f"Unloading idle Whisper model {key}")
+            self._unload(self._models.pop(key))
+        if idle:
+            gc.collect()
+
+    def _evict_for(self, memory, logger):
+        # The models being loaded count as if they were in the cache
+        used = sum(entry[2] for entry in self._models.values())
+        used += sum(loading[1] for loading in self._loading.values())
+        count = len(self._models) + len(self._loading)
+        evicted = False
+        # Least recently used first, skipping the ones in use (which may leave
+        # the cache over its limits until they are released)
+        for key in [key for key, entry in self._models.items() if entry[3] == 0]:
+            if count < self.max_models and used + memory <= self.max_memory:
+                break
+            entry = self._models.pop(key)
+            self._unload(entry)
+            used -= entry[2]
+            count -= 1
+            evicted = True
+            logger.info(f"Unloading least recently used Whisper model {key}")
+        if evicted:
+            gc.collect()
+
+
+whisper_model_cache = WhisperModelCache()
+
+
+# Speed profiles of the local Whisper models. compute_types are the
+# candidates for each device, the autotuner picks the fastest one of them.
+# "batched" decodes many 30 s windows per forward pass, without conditioning on
+# the text before them, so only "fast" uses it. "parallel" uses the process
+# pool on machines without a GPU.
+whisper_profiles = {
+    "fast": {
+        "beam_size": 1,
+        "vad_filter": True,
+        "batched": True,
+        "parallel": True,
+        "compute_types": {"cuda": ["int8_float16", "int8"], "cpu": ["int8"]},
+    },
+    "balanced": {
+        "beam_size": 3,
+        "vad_filter": True,
+        "batched": False,
+        "parallel": True,
+        "compute_types": {
+            "cuda": ["float16", "int8_float16"],
+            "cpu": ["int8", "float32"],
+        },
+    },
+    "accurate": {
+        "beam_size": 5,
+        "vad_filter": False,
+        "batched": False,
+        "parallel": False,
+        "compute_types": {"cuda": ["float16"], "cpu": ["float32"]},
+    },
+}
+
+# Fastest compute type by model, device and candidates, measured once
+tuning_cache = DiskCache("whisper_tuning", max_bytes=1024**2)
+
+
+def get_whisper_device():
+    return "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+
+
+def get_compute_types(profile, device):
+    supported = ctranslate2.get_supported_compute_types(device)
+    compute_types = whisper_profiles[profile]["compute_types"][device]
+    return [t for t in compute_types if t in supported] or ["default"]
+
+
+def autotune_compute_type(
+    model_size, device, compute_types, audio, language=None, logger=None
+):
+    # Times every compute type on the same clip, returns the fastest
     if logger is None:
         logger = logging.getLogger(__name__)
-    transcription = None
-    # try:
-    client = OpenAI(api_key=api_token)
-    with open(audio_file, "rb") as audio:
-        transcription = client.audio.transcriptions.create(
-            model="whisper-1", file=audio, language=language, response_format="text"
+    timings = {}
+    for compute_type in compute_types:
+        model = WhisperModel(model_size, device=device, compute_type=compute_type)
+        start = time.perf_counter()
+        segments, _ = model.transcribe(audio, beam_size=1, language=language)
+        for _ in segments:
+            pass
+        timings[compute_type] = time.perf_counter() - start
+        del model
+        gc.collect()
+    best = min(timings, key=timings.get)
+    measured = ", ".join(f"{t} {timing:.1f}s" for t, timing in timings.items())
+    logger.info(f"Autotuned {model_size} on {device}: {best} ({measured})")
+    return best
+
+
+def get_tuned_compute_type(
+    model_size,
+    profile="balanced",
+    file_path=None,
+    language=None,
+    logger=None,
+    refresh=False,
+):
+    # Returns (device, compute_type). The first time a model is used with
+    # several candidates, 30 s of file_path are used to benchmark them.
+    device = get_whisper_device()
+    compute_types = get_compute_types(profile, device)
+    if len(compute_types) == 1:
+        return device, compute_types[0]
+    key = hash_key(model_size, device, ctranslate2.__version__, *compute_types)
+    compute_type = None if refresh else tuning_cache.get(key)
+    if compute_type is None:
+        if file_path is None:
+            return device, compute_types[0]
+        audio = read_audio_head(file_path, 30)
+        compute_type = autotune_compute_type(
+            model_size, device, compute_types, audio, language=language, logger=logger
         )
+        tuning_cache.set(key, compute_type)
+    return device, compute_type
 
-    print(transcription, "gfdgfdgdg")
 
-    # except Exception as e:
-    #     logger.error(e)
+# Model of each process in the CPU worker pool
+_cpu_worker_model = None
 
-    return transcription
 
+def _load_cpu_worker(model_size, cpu_threads, compute_type):
+    global _cpu_worker_model
+    _cpu_worker_model = WhisperModel(
+        model_size,
+        device="cpu",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=1,
+    )
 
-def fasterWhisperTranscribe(
+
+def _transcribe_cpu_region(audio, language, offset, beam_size):
+    segments, _ = _cpu_worker_model.transcribe(
+        audio, beam_size=beam_size, language=language
+    )
+    return [
+        (segment.start + offset, segment.end + offset, segment.text)
+        for segment in segments
+    ]
+
+
+def get_cpu_worker_layout(
+    model_size, workers=None, threads_per_worker=4, compute_type="int8"
+):
+    # As many model processes as the cores and the model cache's memory budget
+    # allow, with the cores shared out between them as CTranslate2 threads
+    cores = os.cpu_count() or 1
+    if workers is None:
+        memory = estimate_model_memory(model_size, compute_type)
+        workers = min(
+            cores // threads_per_worker, whisper_model_cache.max_memory // memory
+        )
+    workers = max(1, workers)
+    return workers, max(1, cores // workers)
+
+
+def get_speech_regions(audio, sampling_rate=16000, max_region_seconds=30):
+    # Speech found by the VAD, grouped into regions of up to a Whisper window.
+    # The silence between regions is never transcribed.
+    vad_options = VadOptions(
+        min_silence_duration_ms=500, max_speech_duration_s=max_region_seconds
+    )
+    speech = get_speech_timestamps(audio, vad_options)
+    max_length = max_region_seconds * sampling_rate
+    regions = []
+    for item in speech:
+        if regions and item["end"] - regions[-1][0] <= max_length:
+            regions[-1][1] = item["end"]
+        else:
+            regions.append([item["start"], item["end"]])
+    return regions
+
+
+def fasterWhisperParallelSegments(
     file_path,
     language,
     model_size="medium.en",
     update_progress_bar=None,
     logger=None,
-    file_remove=True,
+    workers=None,
+    compute_type="int8",
+    beam_size=5,
 ):
     if logger is None:
         logger = logging.getLogger(__name__)
+    workers, cpu_threads = get_cpu_worker_layout(
+        model_size, workers, compute_type=compute_type
+    )
+    with whisper_model_cache.use(
+        model_size,
+        device=f"cpu x{workers}",
+        compute_type=compute_type,
+        logger=logger,
+        # Spawned, since a forked worker can inherit a lock held by one of the
+        # caller's threads (e.g. a logging handler) and hang
+        loader=lambda: ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_load_cpu_worker,
+            initargs=(model_size, cpu_threads, compute_type),
+        ),
+        memory=workers * estimate_model_memory(model_size, compute_type),
+    ) as pool:
+        sampling_rate = 16000
+        audio = decode_audio(file_path, sampling_rate=sampling_rate)
+        regions = get_speech_regions(audio, sampling_rate=sampling_rate)
+        speech = sum(end - start for start, end in regions)
+        logger.info(
+            f"Transcribing {speech / sampling_rate:.0f}s of speech out of "
+            f"{len(audio) / sampling_rate:.0f}s in {len(regions)} regions with "
+            f"{workers} workers x {cpu_threads} threads"
+        )
 
-    compute_type = "float32" if platform.system() == "Darwin" else "float16"
-    model = WhisperModel(model_size, device="auto", compute_type=compute_type)
+        futures = [
+            pool.submit(
+                _transcribe_cpu_region,
+                audio[start:end],
+                language,
+                start / sampling_rate,
+                beam_size,
+            )
+            for start, end in regions
+        ]
+        try:
+            # Regions are in order and do not overlap, so their segments come
+            # out sorted by timestamp
+            for future, (_, end) in zip(futures, regions):
+                for _, _, text in future.result():
+                    yield text
+                if update_progress_bar is not None:
+                    update_progress_bar(round(end / len(audio) * 0.9, 2))
+        finally:
+            for future in futures:
+                future.cancel()
 
-    if model_size.endswith(".en"):
-        segments, info = model.transcribe(file_path, beam_size=5, language="en")
+
+# Rough memory (bytes) of one 30 s window in a batch, by model
+WHISPER_BATCH_ITEM_MEMORY = {
+    "tiny": 16 * 1024**2,
+    "base": 24 * 1024**2,
+    "small": 64 * 1024**2,
+    "medium": 128 * 1024**2,
+    "large-v1": 192 * 1024**2,
+    "large-v2": 192 * 1024**2,
+    "large-v3": 192 * 1024**2,
+}
+
+
+def get_free_memory(device):
+    # Free memory (bytes) of the first GPU or of this machine, None if unknown
+    if device == "cuda":
+        try:
+            output = subprocess.run(
+                [
+                    "nvidia-smi",
+                    "--query-gpu=memory.free",
+                    "--format=csv,noheader,nounits",
+                    "--id=0",
+                ],
+                capture_output=True,
+                text=True,
+                timeout=10,
+                check=True,
+            ).stdout
+            return int(output.split()[0]) * 1024**2
+        except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+            return None
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_batch_size(
+    model_size, compute_type="default", device="cpu", max_batch_size=32
+):
+    # Fill most of the memory left free next to the loaded model. Without a
+    # way to measure it, fall back to what the model cache's budget leaves.
+    base_size = model_size.split(".")[0]
+    item_memory = WHISPER_BATCH_ITEM_MEMORY.get(base_size, 128 * 1024**2)
+    if compute_type == "float32":
+        item_memory *= 2
+    free = get_free_memory(device)
+    if free is not None:
+        free = int(free * 0.8)
     else:
-        segments, info = model.transcribe(file_path, beam_size=5, language=language)
+        free = whisper_model_cache.max_memory - estimate_model_memory(
+            model_size, compute_type
+        )
+    return max(1, min(max_batch_size, free // item_memory))
+
+
+def fasterWhisperBatchedSegments(
+    file_path,
+    language,
+    model_size="medium.en",
+    update_progress_bar=None,
+    logger=None,
+    device="auto",
+    compute_type="default",
+    beam_size=5,
+    batch_size=None,
+):
+    # Decodes the speech regions found by the VAD in batches of 30 s windows.
+    # Windows are independent, so there is no conditioning on previous text.
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    with whisper_model_cache.use(
+        model_size, device=device, compute_type=compute_type, logger=logger
+    ) as model:
+        if batch_size is None:
+            # Measured once the model is loaded, so it is not counted twice
+            batch_size = get_batch_size(
+                model_size,
+                compute_type,
+                device=get_whisper_device() if device == "auto" else device,
+            )
+        feature_extractor = model.feature_extractor
+        sampling_rate = feature_extractor.sampling_rate
+        audio = decode_audio(file_path, sampling_rate=sampling_rate)
+        regions = get_speech_regions(audio, sampling_rate=sampling_rate)
+        logger.info(f"Transcribing {len(regions)} regions in batches of {batch_size}")
+
+        tokenizer = Tokenizer(
+            model.hf_tokenizer,
+            model.model.is_multilingual,
+            task="transcribe",
+            language=language,
+        )
+        prompt = model.get_prompt(tokenizer, [], without_timestamps=True)
+        suppress_tokens = get_suppressed_tokens(tokenizer, [-1])
+
+        def decode_batch(batch):
+            features = np.stack(
+                [
+                    pad_or_trim(
+                        feature_extractor(
+                            pad_or_trim(audio[start:end], feature_extractor.n_samples),
+                            padding=False,
+                        ),
+                        feature_extractor.nb_max_frames,
+                    )
+                    for start, end in batch
+                ]
+            )
+            encoder_output = model.model.encode(get_ctranslate2_storage(features))
+            results = model.model.generate(
+                encoder_output,
+                [prompt] * len(batch),
+                beam_size=beam_size,
+                max_length=model.max_length,
+                suppress_blank=True,
+                suppress_tokens=suppress_tokens,
+            )
+            return [tokenizer.decode(result.sequences_ids[0]) for result in results]
+
+        index = 0
+        while index < len(regions):
+            batch = regions[index : index + batch_size]
+            try:
+                texts = decode_batch(batch)
+            except RuntimeError as e:
+                # The estimate was too high for this device, retry smaller
+                if "out of memory" not in str(e).lower() or batch_size == 1:
+                    raise
+                batch_size //= 2
+                logger.warning(f"Out of memory, batch size lowered to {batch_size}")
+                continue
+            yield from texts
+            index += len(batch)
+            if update_progress_bar is not None:
+                update_progress_bar(round(batch[-1][1] / len(audio) * 0.9, 2))
+
+
+def fasterWhisperSegments(
+    file_path,
+    language,
+    model_size="medium.en",
+    update_progress_bar=None,
+    logger=None,
+    cpu_workers=None,
+    profile="balanced",
+    batched=None,
+):
+    # cpu_workers=None splits the work over all cores on machines without a
+    # GPU (if the profile allows it), 1 keeps a single model. batched=None
+    # leaves batched decoding to the profile.
+    if logger is None:
+        logger = logging.getLogger(__name__)
 
-    transcription = ""
-    total_duration = round(info.duration, 2)
+    if model_size.endswith(".en"):
+        language = "en"
+    settings = whisper_profiles[profile]
+    device, compute_type = get_tuned_compute_type(
+        model_size, profile, file_path=file_path, language=language, logger=logger
+    )
+    if device == "cpu" and settings["parallel"]:
+        workers, _ = get_cpu_worker_layout(
+            model_size, cpu_workers, compute_type=compute_type
+        )
+        if workers > 1:
+            yield from fasterWhisperParallelSegments(
+                file_path,
+                language,
+                model_size=model_size,
+                update_progress_bar=update_progress_bar,
+                logger=logger,
+                workers=workers,
+                compute_type=compute_type,
+                beam_size=settings["beam_size"],
+            )
+            return
+
+    if batched is None:
+        batched = settings["batched"]
+    if batched:
+        yield from fasterWhisperBatchedSegments(
+            file_path,
+            language,
+            model_size=model_size,
+            update_progress_bar=update_progress_bar,
+            logger=logger,
+            device=device,
+            compute_type=compute_type,
+            beam_size=settings["beam_size"],
+        )
+        return
+
+    with whisper_model_cache.use(
+        model_size, device=device, compute_type=compute_type, logger=logger
+    ) as model:
+        segments, info = model.transcribe(
+            file_path,
+            beam_size=settings["beam_size"],
+            language=language,
+            vad_filter=settings["vad_filter"],
+        )
 
-    for segment in segments:
-        transcription += segment.text
-        if update_progress_bar is not None:
-            update_progress_bar(round(segment.end / total_duration * 0.9, 2))
+        total_duration = round(info.duration, 2)
+
+        for segment in segments:
+            yield segment.text
+            if update_progress_bar is not None:
+                update_progress_bar(round(segment.end / total_duration * 0.9, 2))
+
+
+def fasterWhisperTranscribe(
+    file_path,
+    language,
+    model_size="medium.en",
+    update_progress_bar=None,
+    logger=None,
+    file_remove=True,
+    cpu_workers=None,
+    profile="balanced",
+    batched=None,
+):
+    transcription = "".join(
+        fasterWhisperSegments(
+            file_path,
+            language,
+            model_size=model_size,
+            update_progress_bar=update_progress_bar,
+            logger=logger,
+            cpu_workers=cpu_workers,
+            profile=profile,
+            batched=batched,
+        )
+    )
 
     with open(file_path + ".txt", "w", encoding="utf-8") as file:
         file.write(transcription)
@@ -283,118 +1330,392 @@ def fasterWhisperTranscribe(
     return transcription
 
 
-def split_text_by_token_limit_tiktoken(text, token_limit=3000, model="gpt-3.5-turbo"):
-    encoding = tiktoken.encoding_for_model(model)
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    # Loading an encoding parses its whole BPE table, do it once per process
+    return tiktoken.encoding_for_model(model)
+
+
+# Where a chunk may end: after a sentence (also CJK, which has no space after
+# the stop) or a line break. "3.14" has no space after the dot, so it stays.
+sentence_end = re.compile(
+    r"[.!?…]+[\"'”’」』)\]]*\s+|[。！？]+[\"'”’」』)\]]*\s*|\n+"
+)
+
+# A Whisper segment or subtitle line ending a sentence has no space after it
+ends_with_sentence = re.compile(r"(?:[.!?…。！？][\"'”’」』)\]]*|\n)\s*$")
+
+
+def split_sentences(text):
+    # Yields the sentences of text with their trailing whitespace, so that
+    # joining them gives back text
+    start = 0
+    for match in sentence_end.finditer(text):
+        yield text[start : match.end()]
+        start = match.end()
+    if start < len(text):
+        yield text[start:]
+
+
+def split_tokens_at_characters(text, token_limit, encoding):
+    # Token slices of text, moved back to the last whole character so multi-byte
+    # (e.g. CJK) characters are never cut in half
     tokens = encoding.encode(text)
-    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + token_limit, len(tokens))
+        while True:
+            try:
+                chunk = encoding.decode_bytes(tokens[start:end]).decode("utf-8")
+                break
+            except UnicodeDecodeError:
+                if end - start <= 1:
+                    chunk = encoding.decode(tokens[start:end])
+                    break
+                end -= 1
+        yield chunk
+        start = end
 
-    for i in range(0, len(tokens), token_limit):
-        chunk_tokens = tokens[i : i + token_limit]
-        chunk_text = encoding.decode(chunk_tokens)
-        chunks.append(chunk_text)
 
-    return chunks
+def split_long_text(text, token_limit, encoding):
+    # A sentence over the budget is cut at spaces and commas, and a run with
+    # neither (long CJK text) between characters
+    pieces = re.findall(r"[^\s,，、;；]+[\s,，、;；]*|[\s,，、;；]+", text)
+    chunk, chunk_token_count = "", 0
+    for piece in pieces:
+        token_count = len(encoding.encode(piece))
+        if token_count > token_limit:
+            if chunk:
+                yield chunk
+            chunk, chunk_token_count = "", 0
+            yield from split_tokens_at_characters(piece, token_limit, encoding)
+            continue
+        if chunk and chunk_token_count + token_count > token_limit:
+            yield chunk
+            chunk, chunk_token_count = "", 0
+        chunk += piece
+        chunk_token_count += token_count
+    if chunk:
+        yield chunk
 
 
-def parse_input(input_string):
-    lines = input_string.strip().split("\n")
-    blocks = []
-    last_bulleted_item = None
+def stream_text_by_token_limit_tiktoken(texts, token_limit=1000, model="gpt-3.5-turbo"):
+    # Packs a stream of texts (Whisper segments, subtitle lines or a whole
+    # transcription) into chunks of at most token_limit tokens. Chunks end at
+    # the end of a sentence when one is in their second half, otherwise at the
+    # end of an input text. Only one chunk is held at a time.
+    encoding = get_encoding(model)
+    chunk = []  # (text, token_count, ends_sentence)
+    chunk_token_count = 0
 
-    for line in lines:
-        line_strip = line.strip()
-        if line_strip.startswith("- "):
-            blocks.append(
-                {
-                    "object": "block",
-                    "type": "heading_3",
-                    "heading_3": {
-                        "rich_text": [
-                            {"type": "text", "text": {"content": line_strip[2:]}}
-                        ]
-                    },
-                }
-            )
-        elif line_strip.startswith("* "):
-            bulleted_item = {
-                "object": "block",
-                "type": "bulleted_list_item",
-                "bulleted_list_item": {
-                    "rich_text": [
-                        {"type": "text", "text": {"content": line_strip[2:]}}
-                    ]
-                },
-            }
-            blocks.append(bulleted_item)
-            last_bulleted_item = bulleted_item  # Keep track of the last bulleted item
-        elif line_strip.startswith("** ") and last_bulleted_item:
-            # Add as a sub-item under the last bulleted list item
-            if "children" not in last_bulleted_item["bulleted_list_item"]:
-                last_bulleted_item["bulleted_list_item"]["children"] = []
-            last_bulleted_item["bulleted_list_item"]["children"].append(
-                {
-                    "object": "block",
-                    "type": "bulleted_list_item",
-                    "bulleted_list_item": {
-                        "rich_text": [
-                            {"type": "text", "text": {"content": line_strip[3:]}}
-                        ]
-                    },
-                }
-            )
-        elif line_strip and last_bulleted_item:
-            # Add as a sub-item under the last bulleted list item
-            if "children" not in last_bulleted_item["bulleted_list_item"]:
-                last_bulleted_item["bulleted_list_item"]["children"] = []
-            last_bulleted_item["bulleted_list_item"]["children"].append(
-                {
-                    "object": "block",
-                    "type": "bulleted_list_item",
-                    "bulleted_list_item": {
-                        "rich_text": [
-                            {"type": "text", "text": {"content": re.sub(r'^\*+\s', '', line_strip)}}
-                        ]
-                    },
-                }
-            )
+    def units():
+        for text in texts:
+            for sentence in split_sentences(text):
+                token_count = len(encoding.encode(sentence))
+                if token_count <= token_limit:
+                    yield sentence, token_count
+                    continue
+                for piece in split_long_text(sentence, token_limit, encoding):
+                    yield piece, len(encoding.encode(piece))
 
-    return blocks
+    for text, token_count in units():
+        # What is left after a cut may still not fit with the new text
+        while chunk and chunk_token_count + token_count > token_limit:
+            cut = len(chunk)
+            total = 0
+            for index, (_, count, ends_sentence) in enumerate(chunk):
+                total += count
+                if ends_sentence and total >= token_limit // 2:
+                    cut = index + 1
+            yield "".join(item[0] for item in chunk[:cut])
+            chunk = chunk[cut:]
+            chunk_token_count = sum(item[1] for item in chunk)
+        ends_sentence = ends_with_sentence.search(text) is not None
+        chunk.append((text, token_count, ends_sentence))
+        chunk_token_count += token_count
 
+    if chunk:
+        yield "".join(item[0] for item in chunk)
 
-def resource_path(relative_path):
-    """Get the absolute path to the resource, works for dev and for PyInstaller"""
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
 
-    return os.path.join(base_path, relative_path)
+def split_text_by_token_limit_tiktoken(text, token_limit=3000, model="gpt-3.5-turbo"):
+    return list(stream_text_by_token_limit_tiktoken([text], token_limit, model))
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    return len(get_encoding(model).encode(text))
+
+
+def group_texts_by_token_limit(texts, token_limit=3000, model="gpt-3.5-turbo"):
+    groups = []
+    group = []
+    group_token_count = 0
 
+    for text in texts:
+        token_count = count_tokens(text, model=model)
+        if group and group_token_count + token_count > token_limit:
+            groups.append(group)
+            group = []
+            group_token_count = 0
+        group.append(text)
+        group_token_count += token_count
 
-def check_property_exists(database_id, property_name, headers):
-    url = f"https://api.notion.com/v1/databases/{database_id}"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        database = response.json()
-        return property_name in database["properties"]
+    if group:
+        groups.append(group)
+    return groups
+
+
+def get_tail_by_token_limit(text, token_limit=200, model="gpt-3.5-turbo"):
+    encoding = get_encoding(model)
+    # A character cut by the token limit is dropped from the start
+    tail = encoding.encode(text)[-token_limit:]
+    return encoding.decode_bytes(tail).decode("utf-8", errors="ignore")
+
+
+# Hesitation sounds dropped before note-taking, by Whisper language code.
+# Only sounds with no other meaning, so nothing the speaker said is lost.
+filler_words = {
+    "en": ["um+", "uh+", "uhm", "erm", "hmm+", "mm-hmm"],
+    "es": ["eh+", "ehm", "em+"],
+    "fr": ["euh+", "heu+"],
+    "de": ["äh+", "ähm", "öh+", "hm+"],
+    "it": ["ehm", "uhm"],
+    "pt": ["hum+", "ahn"],
+    "ru": ["э+", "эм+"],
+    "zh": ["嗯+", "呃+"],
+    "ja": ["えーと", "えっと", "えー+", "あのー+"],
+    "ko": ["음+"],
+}
+
+# Languages written without spaces between words
+unspaced_languages = ("zh", "ja")
+# Character loops never include digits, numerals or Latin letters: 一百一百一百,
+# www and AAA are real content. Full-width forms are excluded as well.
+cjk_numerals = "〇一二三四五六七八九十百千万亿两"
+loop_excluded = "\\dA-Za-z０-９Ａ-Ｚａ-ｚ" + cjk_numerals
+
+
+@functools.lru_cache(maxsize=None)
+def get_filler_pattern(language_code):
+    fillers = filler_words.get(language_code)
+    if not fillers:
+        return None
+    # The punctuation of a filler goes with it, "Hmm?" leaves no "?"
+    fillers = "|".join(fillers)
+    if language_code in unspaced_languages:
+        return re.compile(f"(?:{fillers})[,，、.!?。！？]*")
+    return re.compile(f"(?<!\\w)(?:{fillers})(?!\\w)[,，.!?]*", re.IGNORECASE)
+
+
+def collapse_repeated_words(words, max_ngram=8, min_repeats=3):
+    # "a b a b a b" -> "a b": runs of an n-gram repeated min_repeats times or
+    # more are Whisper looping. Runs with digits are kept, "1 1 1" may be data.
+    keys = [normalize_word(word) for word in words]
+    result = []
+    i = 0
+    while i < len(words):
+        for n in range(min(max_ngram, (len(words) - i) // min_repeats), 0, -1):
+            gram = keys[i : i + n]
+            repeats = 1
+            while keys[i + repeats * n : i + (repeats + 1) * n] == gram:
+                repeats += 1
+            if (
+                repeats >= min_repeats
+                and any(gram)
+                and not any(c.isdigit() for key in gram for c in key)
+            ):
+                result += words[i : i + n]
+                i += repeats * n
+                break
+        else:
+            result.append(words[i])
+            i += 1
+    return result
+
+
+def collapse_character_loop(match):
+    loop = match.group(1)
+    if not re.search(r"\w", loop):
+        return match.group(0)
+    if len(loop) == 1:
+        # 谢谢 and 好好 are words, so a doubled one is kept and only longer runs
+        # of one character are a loop
+        return loop * 2 if len(match.group(0)) > 4 else match.group(0)
+    return loop
+
+
+def compress_line(line, language_code, remove_fillers=True, max_ngram=8):
+    leading = line[: len(line) - len(line.lstrip())]
+    trailing = line[len(line.rstrip()) :]
+    if remove_fillers:
+        filler_pattern = get_filler_pattern(language_code)
+        if filler_pattern is not None:
+            line = filler_pattern.sub("", line)
+
+    if language_code in unspaced_languages:
+        # No words to compare, so loops are found on characters
+        line = re.sub(
+            rf"([^{loop_excluded}]{{1,{max_ngram * 2}}}?)\1{{2,}}",
+            collapse_character_loop,
+            line,
+        )
+        line = re.sub(r"[ \t]+", " ", line).strip()
     else:
-        return False
+        words = collapse_repeated_words(line.split(), max_ngram=max_ngram)
+        line = " ".join(words)
+
+    # Whitespace and punctuation left over by the removals, or by the source
+    line = re.sub(r"([.!?。！？])\s+[.。](?=\s|$)", r"\1", line)
+    # Only punctuation that ends a word, not the start of .NET, .5 or :)
+    line = re.sub(r"[ \t]+([,.!?;:])(?=\s|$)", r"\1", line)
+    line = re.sub(r"[ \t]+([，。！？；：、])", r"\1", line)
+    line = re.sub(r"[,，、]+(?=[.!?。！？])", "", line)
+    # Not ":" as in std::vector
+    line = re.sub(r"([,!?;，。！？；、])\1+", r"\1", line)
+    line = re.sub(r"\.{4,}", "...", line)
+    # Not a "." that starts .NET or .5
+    line = re.sub(r"^(?:[,，。、]|\.(?=\s|$))+\s*", "", line)
+    if not re.search(r"\w", line):
+        # Only punctuation is left
+        return ""
+    return leading + line + trailing
+
 
+def compress_transcript(text, language_code, remove_fillers=True, max_ngram=8):
+    # Drops what costs LLM tokens but carries no content: hesitation sounds,
+    # Whisper repetition loops and stray whitespace/punctuation. Line breaks
+    # and numbers are kept.
+    return "\n".join(
+        compress_line(line, language_code, remove_fillers, max_ngram)
+        for line in text.split("\n")
+    )
 
-def add_property_to_database(
-    database_id, property_name, property_type, headers, logger=None
+
+def compress_text_stream(
+    texts, language_code, logger=None, remove_fillers=True, max_ngram=8
 ):
+    # compress_transcript for a stream of Whisper segments, which also drops a
+    # loop spread over segments: a segment of more than 4 words repeating one
+    # of the last two, or a shorter one repeating both ("Thank you." twice is
+    # speech)
     if logger is None:
         logger = logging.getLogger(__name__)
-    url = f"https://api.notion.com/v1/databases/{database_id}"
-    update_payload = {
-        "properties": {property_name: {"type": property_type, property_type: {}}}
+    recent = deque(maxlen=2)
+    tokens_before = tokens_after = 0
+    for text in texts:
+        tokens_before += count_tokens(text)
+        compressed = compress_transcript(
+            text, language_code, remove_fillers=remove_fillers, max_ngram=max_ngram
+        )
+        key = " ".join(normalize_word(word) for word in compressed.split())
+        repeats = list(recent).count(key)
+        if not key or (
+            (repeats == 2 or (repeats and len(key.split()) > 4))
+            and not any(c.isdigit() for c in key)
+        ):
+            continue
+        recent.append(key)
+        tokens_after += count_tokens(compressed)
+        yield compressed
+    log_compression(tokens_before, tokens_after, logger)
+
+
+def log_compression(tokens_before, tokens_after, logger):
+    saved = 1 - tokens_after / tokens_before if tokens_before else 0
+    logger.info(
+        f"Transcript compressed from {tokens_before} to {tokens_after} tokens "
+        f"({saved:.0%} fewer)"
+    )
+
+
+def text_block(block_type, content):
+    return {
+        "object": "block",
+        "type": block_type,
+        block_type: {"rich_text": [{"type": "text", "text": {"content": content}}]},
     }
-    response = requests.patch(url, headers=headers, json=update_payload)
-    if response.status_code == 200:
-        logger.info(f"Property '{property_name}' added to the database.")
-    else:
-        logger.warning(
-            f"Failed to add property to database: {response.status_code}, {response.text}"
+
+
+class NotesParser:
+    """Incremental parse_input for notes that are still being generated.
+
+    feed() takes any piece of text and returns the blocks finished by it. A
+    bulleted item is only finished once a line that is not its child comes in,
+    since the "** " lines after it are nested under it.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.last_bulleted_item = None
+        self.started = False
+
+    def feed(self, text):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        blocks = []
+        for line in lines:
+            blocks += self.parse_line(line)
+        return blocks
+
+    def close(self):
+        blocks = self.parse_line(self.buffer) + self.finish_item()
+        self.buffer = ""
+        return blocks
+
+    def finish_item(self):
+        if self.last_bulleted_item is None:
+            return []
+        item, self.last_bulleted_item = self.last_bulleted_item, None
+        return [item]
+
+    def parse_line(self, line):
+        line_strip = line.strip()
+        if line_strip.startswith("- "):
+            # A topic ends the detail before it, later lines go under the topic
+            self.started = True
+            return self.finish_item() + [text_block("heading_3", line_strip[2:])]
+        if line_strip.startswith("* "):
+            self.started = True
+            blocks = self.finish_item()
+            self.last_bulleted_item = text_block("bulleted_list_item", line_strip[2:])
+            return blocks
+        if not line_strip or not self.started:
+            # Lines before the first topic or detail are the model's preamble
+            return []
+
+        if line_strip.startswith("** "):
+            content = line_strip[3:]
+        else:
+            content = re.sub(r"^\*+\s", "", line_strip)
+        if self.last_bulleted_item is None:
+            return [text_block("bulleted_list_item", content)]
+        # Add as a sub-item under the last bulleted list item
+        item = self.last_bulleted_item["bulleted_list_item"]
+        item.setdefault("children", []).append(
+            text_block("bulleted_list_item", content)
         )
+        return []
+
+
+def parse_input(input_string):
+    parser = NotesParser()
+    return parser.feed(input_string.strip()) + parser.close()
+
+
+def file_digest(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def resource_path(relative_path):
+    """Get the absolute path to the resource, works for dev and for PyInstaller"""
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+
+    return os.path.join(base_path, relative_path)